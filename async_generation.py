@@ -0,0 +1,203 @@
+import time
+import asyncio
+
+import numpy as np
+
+from homebrew import expand_iter
+from segment_store import SegmentStore
+from forest import TreeJob
+from forest import job_tree
+from forest import tree_buffers
+from forest import buffers_to_geom_node
+from mesh_cache import job_key
+import geometry
+
+
+# Generating trees without blocking the frame loop. A tree is either
+# generated on the main thread in slices of a few milliseconds per frame,
+# or in an executor (e.g. a ProcessPoolExecutor) off the main thread. A
+# request for a target supersedes any earlier one for it, and the
+# finished geometry replaces the target's in a single step, so no frame
+# ever shows a half-built or missing tree.
+#
+# Requests `in_place` regrow a tree whose age changed. That changes the
+# lengths, radii and angles of its segments, but for a given seed the
+# segments usually stay the same: Splitting doesn't depend on age at
+# all, and the number of branches only does where the branch density
+# function crosses an integer. So if the topology hasn't changed, the
+# new vertices are written into the target's existing GeomVertexData
+# (which is created with Geom.UHDynamic for that reason), and only
+# otherwise is the Geom replaced.
+
+
+def buffer_steps(job, tropisms=True, circle_segments=10, bark_tris=True, budget=0.004):
+    # Does the work of `forest.tree_buffers` in slices of about `budget`
+    # seconds. Yields the number of segments expanded so far after each
+    # slice, and returns the vertex and index buffers.
+    store = SegmentStore()
+    deadline = time.perf_counter() + budget
+    segments = expand_iter(job_tree(job), tropisms=tropisms, scene_graph=False, release_segments=True)
+    for segment in segments:
+        store.add(segment)
+        if time.perf_counter() > deadline:
+            yield len(store)
+            deadline = time.perf_counter() + budget
+    rings = geometry.gather_rings(store)
+    vertices = geometry.ring_vertices(rings, circle_segments)
+    yield len(store)
+    indices = geometry.bark_indices(rings, circle_segments, bark_tris)
+    return vertices.tobytes(), indices.astype(np.uint32).tobytes()
+
+
+def swap_geoms(target, source):
+    # Replaces the geoms of GeomNode `target` with those of `source`.
+    target.remove_all_geoms()
+    for idx in range(source.get_num_geoms()):
+        target.add_geom(source.modify_geom(idx), source.get_geom_state(idx))
+
+
+class TreeRequest:
+    # The state of one tree being generated. `progress` is the number of
+    # segments expanded so far, if generated on the main thread.
+    # `updated_in_place` tells whether an `in_place` request could keep
+    # the target's Geom.
+    def __init__(self, target, job, tropisms, circle_segments, bark_tris, on_done, in_place=False):
+        self.target = target
+        self.job = job
+        self.tropisms = tropisms
+        self.circle_segments = circle_segments
+        self.bark_tris = bark_tris
+        self.on_done = on_done
+        self.in_place = in_place
+        self.updated_in_place = False
+        self.progress = 0
+        self.done = False
+        self.cancelled = False
+        self.steps = None
+        self.future = None
+
+    def cancel(self):
+        if self.done:
+            return
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()  # A running job's result is just ignored.
+        if self.steps is not None:
+            self.steps.close()
+
+
+class AsyncTreeGenerator:
+    # Generates trees from a task on `task_mgr`. With an `executor`, the
+    # trees are generated there, else on the main thread, using at most
+    # about `budget` seconds per frame. With a `mesh_cache`, cached
+    # trees are swapped in right away, and new ones are cached.
+    def __init__(self, task_mgr, executor=None, budget=0.004, mesh_cache=None, name='tree_generation'):
+        self.executor = executor
+        self.budget = budget
+        self.mesh_cache = mesh_cache
+        self.requests = {}
+        self.task = task_mgr.add(self.update, name)
+
+    def request(self, target, job, tropisms=True, circle_segments=10, bark_tris=True, on_done=None, in_place=False):
+        # Generates the tree of `job`, and swaps it into GeomNode `target`
+        # when done, superseding earlier requests for `target`. Then calls
+        # `on_done(request)`, if given. With `in_place`, `target` has to
+        # hold a tree from the same job at another age, made with the
+        # same parameters, and is updated in place where possible.
+        job = TreeJob(*job)
+        # PandaNodes hash and compare by the node, not by the Python
+        # wrapper, so each `.node()` call finds the same request.
+        key = target
+        if key in self.requests:
+            self.requests.pop(key).cancel()
+        request = TreeRequest(target, job, tropisms, circle_segments, bark_tris, on_done, in_place)
+
+        if self.mesh_cache is not None:
+            cache_key = job_key(job, tropisms, circle_segments, bark_tris)
+            node = self.mesh_cache.get_geom_node(cache_key)
+            if node is not None:
+                self._finish(request, node)
+                return request
+
+        if self.executor is not None:
+            request.future = self.executor.submit(
+                tree_buffers, job, tropisms, circle_segments, bark_tris,
+            )
+        else:
+            request.steps = buffer_steps(job, tropisms, circle_segments, bark_tris, self.budget)
+        self.requests[key] = request
+        return request
+
+    def cancel(self, target):
+        request = self.requests.pop(target, None)
+        if request is not None:
+            request.cancel()
+
+    def _done(self, request):
+        request.done = True
+        if request.on_done is not None:
+            request.on_done(request)
+
+    def _finish(self, request, node):
+        swap_geoms(request.target, node)
+        self._done(request)
+
+    def _finish_buffers(self, request, buffers):
+        if self.mesh_cache is not None:
+            cache_key = job_key(request.job, request.tropisms, request.circle_segments, request.bark_tris)
+            self.mesh_cache.put(cache_key, buffers, request.bark_tris)
+        if request.in_place:
+            vertex_bytes, index_bytes = buffers
+            request.updated_in_place = geometry.update_geom_node(
+                request.target,
+                np.frombuffer(vertex_bytes, dtype=geometry.vertex_dtype),
+                np.frombuffer(index_bytes, dtype=np.uint32),
+                request.bark_tris,
+            )
+            self._done(request)
+        else:
+            self._finish(request, buffers_to_geom_node(buffers, request.bark_tris))
+
+    def update(self, task):
+        deadline = time.perf_counter() + self.budget
+        for key, request in list(self.requests.items()):
+            if request.future is not None:
+                if not request.future.done():
+                    continue
+                buffers = request.future.result()
+            else:
+                if time.perf_counter() > deadline:
+                    continue  # Out of time; The request goes on next frame.
+                try:
+                    request.progress = next(request.steps)
+                    continue
+                except StopIteration as stop:
+                    buffers = stop.value
+            del self.requests[key]
+            self._finish_buffers(request, buffers)
+        return task.cont
+
+    def destroy(self):
+        for request in self.requests.values():
+            request.cancel()
+        self.requests = {}
+        self.task.remove()
+
+
+async def tree_buffers_async(job, tropisms=True, circle_segments=10, bark_tris=True, executor=None, budget=0.004):
+    # The asyncio counterpart of `forest.tree_buffers`; Runs in `executor`,
+    # or in the event loop in slices of about `budget` seconds. Cancel the
+    # asyncio task to cancel the generation.
+    job = TreeJob(*job)
+    if executor is not None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, tree_buffers, job, tropisms, circle_segments, bark_tris,
+        )
+    steps = buffer_steps(job, tropisms, circle_segments, bark_tris, budget)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+        await asyncio.sleep(0)
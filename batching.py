@@ -0,0 +1,119 @@
+import numpy as np
+
+from panda3d.core import NodePath
+from panda3d.core import LMatrix4f
+from panda3d.core import CullFaceAttrib
+
+from segment_store import SegmentStore
+from segment_store import store_from_tree
+import geometry
+import leaves
+
+
+# Many trees in few Geoms. The meshes of many expanded trees are written
+# straight into a few large vertex and index buffers per material (bark,
+# and leaves), with each tree's world transform baked into its vertices.
+# All sizes are known from the trees' rings before any vertex is
+# computed, so each buffer is allocated once, at its final size.
+
+
+def _transform_mat(transform):
+    if isinstance(transform, LMatrix4f):
+        return np.array(geometry._mat_row_major(transform), dtype=np.float32).reshape(4, 4)
+    return np.asarray(transform, dtype=np.float32).reshape(4, 4)
+
+
+def _transform_vertices(vertices, mat):
+    # In place; `mat` is a row-vector transform as Panda3D uses them.
+    vertices['vertex'] = vertices['vertex'] @ mat[:3, :3] + mat[3, :3]
+    normals = vertices['normal'] @ mat[:3, :3]
+    lengths = np.linalg.norm(normals, axis=-1, keepdims=True)
+    vertices['normal'] = normals / np.maximum(lengths, 1e-12)
+
+
+def batch_groups(counts, max_vertices):
+    # Splits the trees into runs whose vertex counts add up to at most
+    # `max_vertices`; A tree larger than that gets a batch of its own.
+    groups = []
+    group = []
+    total = 0
+    for idx, count in enumerate(counts):
+        if group and total + count > max_vertices:
+            groups.append(group)
+            group = []
+            total = 0
+        group.append(idx)
+        total += count
+    if group:
+        groups.append(group)
+    return groups
+
+
+def _batch_nodes(meshes, vertex_counts, index_counts, mats, bark_tris, max_vertices, name):
+    # `meshes(idx)` returns the vertices and indices of tree `idx`.
+    nodes = []
+    for batch_idx, group in enumerate(batch_groups(vertex_counts, max_vertices)):
+        vertices = np.empty(sum(vertex_counts[idx] for idx in group), dtype=geometry.vertex_dtype)
+        indices = np.empty(sum(index_counts[idx] for idx in group), dtype=np.uint32)
+        vertex_start = 0
+        index_start = 0
+        for idx in group:
+            tree_vertices, tree_indices = meshes(idx)
+            vertex_end = vertex_start + len(tree_vertices)
+            index_end = index_start + len(tree_indices)
+            vertices[vertex_start:vertex_end] = tree_vertices
+            _transform_vertices(vertices[vertex_start:vertex_end], mats[idx])
+            indices[index_start:index_end] = tree_indices
+            indices[index_start:index_end] += vertex_start
+            vertex_start = vertex_end
+            index_start = index_end
+        nodes.append(geometry.make_geom_node(vertices, indices, bark_tris, name='{}_{}'.format(name, batch_idx)))
+    return nodes
+
+
+def batched_trees(trees, transforms, circle_segments=10, bark_tris=True, with_leaves=True, max_vertices=2**20):
+    # `trees` are expanded trees or SegmentStores, and `transforms` their
+    # world transforms as Mat4s or (4, 4) arrays. Returns a NodePath with
+    # the bark batches, and the leaf batches if there are leaves.
+    stores = [tree if isinstance(tree, SegmentStore) else store_from_tree(tree) for tree in trees]
+    mats = [_transform_mat(transform) for transform in transforms]
+    batches = NodePath('batched_trees')
+
+    indices_per_quad = 6 if bark_tris else 2
+    all_rings = [geometry.gather_rings(store) for store in stores]
+    bark_nodes = _batch_nodes(
+        lambda idx: (
+            geometry.ring_vertices(all_rings[idx], circle_segments),
+            geometry.bark_indices(all_rings[idx], circle_segments, bark_tris),
+        ),
+        [len(rings.radii) * circle_segments for rings in all_rings],
+        [len(rings.connections) * circle_segments * indices_per_quad for rings in all_rings],
+        mats,
+        bark_tris,
+        max_vertices,
+        'bark_batch',
+    )
+    for node in bark_nodes:
+        batches.attach_new_node(node)
+
+    if with_leaves:
+        all_frames = [leaves.leaf_frames(store) for store in stores]
+        leaf_counts = [len(frames[0]) for frames in all_frames]
+        if sum(leaf_counts) > 0:
+            indices_per_leaf = 6 if bark_tris else 8
+            leaf_nodes = _batch_nodes(
+                lambda idx: (
+                    leaves.leaf_vertices(*all_frames[idx]),
+                    leaves.leaf_indices(leaf_counts[idx], bark_tris),
+                ),
+                [count * 4 for count in leaf_counts],
+                [count * indices_per_leaf for count in leaf_counts],
+                mats,
+                bark_tris,
+                max_vertices,
+                'leaf_batch',
+            )
+            for node in leaf_nodes:
+                node.set_attrib(CullFaceAttrib.make(CullFaceAttrib.M_cull_none))
+                batches.attach_new_node(node)
+    return batches
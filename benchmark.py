@@ -0,0 +1,324 @@
+import sys
+import json
+import time
+import resource
+import itertools
+import functools
+import platform
+import argparse
+import subprocess
+
+from panda3d.core import Vec3
+
+from tree_specs import StemDefinition as sd
+from tree_specs import Segment as sg
+from blending_functions import constant
+from blending_functions import linear
+from blending_functions import noisy_linear_length
+from blending_functions import boring_radius
+from blending_functions import s_curvature
+from blending_functions import error_smoothing
+from blending_functions import equal_split_rotation_func
+from blending_functions import branch_density
+from blending_functions import branch_length_function
+from homebrew import expand_fully
+from homebrew import ExpansionProfile
+from segment_store import SegmentStore
+import tree_species
+import geometry
+
+
+# Headless benchmarks for tree generation. Runs the species from
+# `tree_species` and synthetic species of increasing size, and reports
+# throughput, peak memory and the time spent in each stage. Each species
+# is generated both the batched way (Frames, a SegmentStore and the
+# vectorized mesh functions), and the scene graph way (NodePaths and the
+# legacy `geometry.trimesh`). Peak memory is the peak resident set size
+# of a fresh process generating the case's trees, so it includes
+# Panda3D's and numpy's allocations, not just Python's, and also the
+# interpreter and libraries themselves.
+# Results can be written to JSON, and compared to an earlier run:
+#
+#     python benchmark.py --output new.json --compare old.json
+
+
+def stress_species(segments=10, density=5.0, split_chance=0.0, child_segments=5, levels=2):
+    # A synthetic species with `levels` levels of stems. Every stem but
+    # the last level's has `density` branches per segment.
+    def level_definition(level):
+        definition = {
+            sd.SEGMENTS: segments if level == 0 else child_segments,
+            sd.LENGTH: noisy_linear_length(1, 8, 0) if level == 0 else branch_length_function(linear(2.0, 1.0)),
+            sd.RADIUS: boring_radius(0.5, 0.1) if level == 0 else constant(0.04),
+            sd.BENDING: s_curvature(20, -20, 30, 30, constant(0.0), linear(0.2, 1.0)),
+            sd.DESIGN_TROPISM: constant(1.0),
+            sd.HELIOTROPISM: constant(0.2),
+        }
+        if level > 0:
+            definition[sd.BRANCH_ANGLE] = linear(90.0, 30.0)
+            definition[sd.BRANCH_ROTATION] = noisy_linear_length(0.0, 0.0, 180.0)
+        if split_chance > 0.0:
+            definition[sd.SPLIT_CHANCE] = error_smoothing(constant(split_chance))
+            definition[sd.SPLIT_ANGLE] = equal_split_rotation_func(linear(40.0, 20.0))
+        if level < levels - 1:
+            definition[sd.BRANCH_DENSITY] = branch_density(constant(density))
+            definition[sd.CHILD_DEFINITION] = level_definition(level + 1)
+        return definition
+    return level_definition(0)
+
+
+def has_tropisms(definition):
+    if sd.DESIGN_TROPISM not in definition or sd.HELIOTROPISM not in definition:
+        return False
+    if sd.CHILD_DEFINITION in definition:
+        return has_tropisms(definition[sd.CHILD_DEFINITION])
+    return True
+
+
+def benchmark_cases(quick=False):
+    cases = []
+    for name in ['BoringWillowish', 'BoringFirish', 'BoringBoringish']:
+        cases.append((name, getattr(tree_species, name)))
+
+    if quick:
+        densities = [2.0, 8.0]
+        segment_counts = [10]
+        split_chances = [0.0, 0.2]
+    else:
+        densities = [1.0, 2.0, 4.0, 8.0, 16.0]
+        segment_counts = [5, 10, 20, 40]
+        split_chances = [0.0, 0.1, 0.2, 0.4]
+    for density in densities:
+        cases.append(('stress density={}'.format(density), stress_species(density=density)))
+    for segments in segment_counts:
+        cases.append(('stress segments={}'.format(segments), stress_species(segments=segments)))
+    for split_chance in split_chances:
+        cases.append(('stress split_chance={}'.format(split_chance), stress_species(split_chance=split_chance)))
+    cases.append(('stress levels=3', stress_species(density=4.0, levels=3)))
+    return cases
+
+
+def count_segments(tree):
+    count = 0
+    segments = [tree]
+    while segments:
+        s = segments.pop()
+        count += 1
+        segments += s[sg.CONTINUATIONS]
+        segments += s[sg.BRANCHES]
+    return count
+
+
+def generate(definition, seed, tropisms, circle_segments, timings, collector=None, scene_graph=False):
+    # One full generation, adding each stage's duration to `timings`.
+    def timed(stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+    tree = {
+        sg.DEFINITION: definition,
+        sg.RNG_SEED: seed,
+        sg.AGE: 1.0,
+        sg.HELIOTROPIC_DIRECTION: Vec3(0, 0, 1),
+    }
+    if scene_graph:
+        timed('expand', expand_fully, tree, tropisms=tropisms, scene_graph=True, collector=collector)
+        node = timed('trimesh', geometry.trimesh, tree, circle_segments)
+        geom = node.get_geom(0)
+        num_vertices = geom.get_vertex_data().get_num_rows()
+        return count_segments(tree), num_vertices, geom.get_primitive(0).get_num_primitives()
+
+    store = SegmentStore()
+    timed('expand', expand_fully, tree, tropisms=tropisms, scene_graph=False, store=store, collector=collector)
+    rings = timed('rings', geometry.gather_rings, store)
+    vertices = timed('vertices', geometry.ring_vertices, rings, circle_segments)
+    indices = timed('indices', geometry.bark_indices, rings, circle_segments)
+    timed('geom_node', geometry.make_geom_node, vertices, indices)
+    return len(store), len(vertices), len(indices) // 3
+
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure_memory(case_index, quick, seeds, circle_segments, scene_graph):
+    # Runs in a fresh process (see `case_memory`), and prints its peak
+    # resident set size after generating the case's trees.
+    name, definition = benchmark_cases(quick)[case_index]
+    tropisms = has_tropisms(definition)
+    for seed in range(seeds):
+        generate(definition, seed, tropisms, circle_segments, {}, scene_graph=scene_graph)
+    print(peak_rss_bytes())
+
+
+def case_memory(case_index, quick, seeds, circle_segments, scene_graph):
+    command = [
+        sys.executable, __file__,
+        '--memory-case', str(case_index),
+        '--seeds', str(seeds),
+        '--circle-segments', str(circle_segments),
+    ]
+    if quick:
+        command.append('--quick')
+    if not scene_graph:
+        command.append('--no-scene-graph')
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return int(output.split()[-1])
+
+
+def run_case(name, definition, seeds=3, repeat=3, circle_segments=10, scene_graph=False, memory=None):
+    # `memory` is a function of `seeds`, `circle_segments` and
+    # `scene_graph` that measures the case's peak memory; Without it,
+    # none is reported.
+    tropisms = has_tropisms(definition)
+    if scene_graph:
+        name = '{} (scene graph)'.format(name)
+    best = None
+    for _ in range(repeat):
+        timings = {}
+        segments = vertices = triangles = 0
+        for seed in range(seeds):
+            s, v, t = generate(definition, seed, tropisms, circle_segments, timings, scene_graph=scene_graph)
+            segments += s
+            vertices += v
+            triangles += t
+        if best is None or sum(timings.values()) < sum(best.values()):
+            best = timings
+
+    # Memory is measured in a process of its own, as this one's peak has
+    # been reached by earlier cases already.
+    peak_memory = None
+    if memory is not None:
+        peak_memory = memory(seeds=seeds, circle_segments=circle_segments, scene_graph=scene_graph)
+
+    # The breakdown of the expansion into its stages is measured
+    # separately, as collecting it slows everything down.
+    profile = ExpansionProfile()
+    for seed in range(seeds):
+        generate(definition, seed, tropisms, circle_segments, {}, collector=profile, scene_graph=scene_graph)
+
+    total = sum(best.values())
+    return {
+        'name': name,
+        'scene_graph': scene_graph,
+        'tropisms': tropisms,
+        'trees': seeds,
+        'segments': segments,
+        'vertices': vertices,
+        'triangles': triangles,
+        'seconds': total,
+        'timings': best,
+        'expand_stages': profile.stage_seconds(),
+        'segments_per_level': {str(level): count for level, count in profile.segments.items()},
+        'segments_per_second': segments / total,
+        'vertices_per_second': vertices / total,
+        'peak_rss_bytes': peak_memory,
+    }
+
+
+def run(quick=False, seeds=3, repeat=3, scene_graph=True, circle_segments=10):
+    # With `scene_graph`, each species is also run the scene graph way.
+    results = []
+    modes = [False, True] if scene_graph else [False]
+    for ((case_index, (name, definition)), mode) in itertools.product(enumerate(benchmark_cases(quick)), modes):
+        memory = functools.partial(case_memory, case_index, quick)
+        result = run_case(
+            name,
+            definition,
+            seeds=seeds,
+            repeat=repeat,
+            circle_segments=circle_segments,
+            scene_graph=mode,
+            memory=memory,
+        )
+        results.append(result)
+        print(
+            '{:48} {:7d} segs {:8d} verts {:9.0f} segs/s {:10.0f} verts/s {:7.1f} MiB'.format(
+                result['name'],
+                result['segments'],
+                result['vertices'],
+                result['segments_per_second'],
+                result['vertices_per_second'],
+                result['peak_rss_bytes'] / 1024**2,
+            ),
+        )
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def compare(old, new):
+    old_results = {result['name']: result for result in old['results']}
+    for result in new['results']:
+        if result['name'] not in old_results:
+            continue
+        old_result = old_results[result['name']]
+        stages = ', '.join(
+            '{} {:.2f}x'.format(stage, old_result['timings'][stage] / seconds)
+            for stage, seconds in result['timings'].items()
+            if stage in old_result['timings'] and seconds > 0.0
+        )
+        # Older results measured only the Python heap, which isn't
+        # comparable.
+        if result['peak_rss_bytes'] is None or old_result.get('peak_rss_bytes') is None:
+            memory = 'n/a'
+        else:
+            memory = '{:.2f}x'.format(result['peak_rss_bytes'] / max(1, old_result['peak_rss_bytes']))
+        print(
+            '{:48} {:.2f}x segs/s, {} memory ({})'.format(
+                result['name'],
+                result['segments_per_second'] / old_result['segments_per_second'],
+                memory,
+                stages,
+            ),
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark tree generation.")
+    parser.add_argument('--output', help="Write the results to this JSON file.")
+    parser.add_argument('--compare', help="Compare the results to this earlier JSON file.")
+    parser.add_argument('--quick', action='store_true', help="Run fewer stress species.")
+    parser.add_argument('--seeds', type=int, default=3, help="Trees per species and run.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per species; The fastest counts.")
+    parser.add_argument('--circle-segments', type=int, default=10, help="Vertices per ring.")
+    parser.add_argument(
+        '--no-scene-graph',
+        action='store_true',
+        help="Skip the NodePath expansion and legacy trimesh runs.",
+    )
+    parser.add_argument('--memory-case', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.memory_case is not None:
+        # A worker of `case_memory`; Here, `--no-scene-graph` selects the
+        # batched way for the one case.
+        measure_memory(args.memory_case, args.quick, args.seeds, args.circle_segments, not args.no_scene_graph)
+        return
+
+    report = run(
+        quick=args.quick,
+        seeds=args.seeds,
+        repeat=args.repeat,
+        scene_graph=not args.no_scene_graph,
+        circle_segments=args.circle_segments,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print()
+        compare(old, report)
+
+
+if __name__ == '__main__':
+    main()
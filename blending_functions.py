@@ -1,83 +1,275 @@
 import math
 
+import numpy as np
+
 from panda3d.core import Vec3
 
 
-def constant(value):
-    def inner(_age, _ratio, _rng):
-        return value
-    return inner
+# Blending functions are small callable objects instead of closures, so
+# that they (and with them, stem definitions) can be compared, hashed,
+# pickled, and converted to and from plain dicts. Their parameters are
+# their `__slots__`, in the order of the constructor's arguments.
+#
+# Besides being called per segment, each also has a `batch` method that
+# evaluates it for a whole array of ratios at once, drawing its noise in
+# batches from a `counter_rng.CounterRNG` (or a NumPy `Generator`).
+# Functions that don't draw random numbers at all (see `uses_rng`) give
+# the same results either way; `batchable` tells whether a function can
+# be batched at all.
+
+
+blending_function_types = {}
+
+
+class BlendingFunction:
+    __slots__ = ()
+    random_draws = False  # Does the function itself use the RNG?
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        blending_function_types[cls.__name__] = cls
+
+    def params(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def uses_rng(self):
+        # Does the function, or any of the functions it is made of, use
+        # the RNG?
+        return self.random_draws or any(
+            param.uses_rng() for param in self.params()
+            if isinstance(param, BlendingFunction)
+        )
+
+    def batchable(self):
+        # Can `batch` be used instead of calling the function per
+        # segment? Not if it uses the RNG, nor if any of its parameters
+        # is a callable that isn't a BlendingFunction, and so has no
+        # `batch` of its own.
+        return not self.uses_rng() and all(
+            param.batchable() if isinstance(param, BlendingFunction) else not callable(param)
+            for param in self.params()
+        )
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.params() == other.params()
+
+    def __hash__(self):
+        return hash((type(self).__name__, self.params()))
+
+    def __repr__(self):
+        return '{}({})'.format(
+            type(self).__name__,
+            ', '.join(repr(param) for param in self.params()),
+        )
+
+    def __reduce__(self):
+        return (type(self), self.params())
+
+    def to_dict(self):
+        data = {'type': type(self).__name__}
+        for name in self.__slots__:
+            data[name] = to_dict(getattr(self, name))
+        return data
 
 
-def linear(v_from, v_to):
-    def inner(_age, ratio, _rng):
-        return v_from + (v_to - v_from) * ratio
-    return inner
+def to_dict(value):
+    if isinstance(value, BlendingFunction):
+        return value.to_dict()
+    elif isinstance(value, (list, tuple)):
+        return [to_dict(v) for v in value]
+    return value
 
 
-def noisy_linear_length(v_from, v_to, v_noise):
-    def inner(age, ratio, rng):
-        v = v_from + (v_to - v_from) * age
-        v += rng.uniform(-1, 1) * v_noise
+def from_dict(data):
+    if isinstance(data, dict):
+        data = dict(data)
+        cls = blending_function_types[data.pop('type')]
+        return cls(**{name: from_dict(value) for name, value in data.items()})
+    elif isinstance(data, list):
+        return [from_dict(v) for v in data]
+    return data
+
+
+class Constant(BlendingFunction):
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, _age, _ratio, _rng):
+        return self.value
+
+    def batch(self, _age, ratios, _rng):
+        return np.full(np.shape(ratios), self.value, dtype=np.float64)
+
+
+class Linear(BlendingFunction):
+    __slots__ = ('v_from', 'v_to')
+
+    def __init__(self, v_from, v_to):
+        self.v_from = v_from
+        self.v_to = v_to
+
+    def __call__(self, _age, ratio, _rng):
+        return self.v_from + (self.v_to - self.v_from) * ratio
+
+    def batch(self, _age, ratios, _rng):
+        return self.v_from + (self.v_to - self.v_from) * np.asarray(ratios, dtype=np.float64)
+
+
+class NoisyLinearLength(BlendingFunction):
+    __slots__ = ('v_from', 'v_to', 'v_noise')
+    random_draws = True
+
+    def __init__(self, v_from, v_to, v_noise):
+        self.v_from = v_from
+        self.v_to = v_to
+        self.v_noise = v_noise
+
+    def __call__(self, age, ratio, rng):
+        v = self.v_from + (self.v_to - self.v_from) * age
+        v += rng.uniform(-1, 1) * self.v_noise
         return v
-    return inner
 
+    def batch(self, age, ratios, rng):
+        v = self.v_from + (self.v_to - self.v_from) * np.asarray(age, dtype=np.float64)
+        return v + rng.uniform(-1, 1, np.shape(ratios)) * self.v_noise
+
+
+class BoringRadius(BlendingFunction):
+    __slots__ = ('v_from', 'v_to')
 
-def boring_radius(v_from, v_to):
-    def inner(age, ratio, _rng):
-        return (v_from + (v_to - v_from) * ratio) * age
-    return inner
+    def __init__(self, v_from, v_to):
+        self.v_from = v_from
+        self.v_to = v_to
 
+    def __call__(self, age, ratio, _rng):
+        return (self.v_from + (self.v_to - self.v_from) * ratio) * age
 
-def func_curvature(twist_func, pitch_func, curve_func):
-    def inner(age, ratio, rng):
+    def batch(self, age, ratios, _rng):
+        return (self.v_from + (self.v_to - self.v_from) * np.asarray(ratios, dtype=np.float64)) * age
+
+
+class FuncCurvature(BlendingFunction):
+    __slots__ = ('twist_func', 'pitch_func', 'curve_func')
+
+    def __init__(self, twist_func, pitch_func, curve_func):
+        self.twist_func = twist_func
+        self.pitch_func = pitch_func
+        self.curve_func = curve_func
+
+    def __call__(self, age, ratio, rng):
         return (
-            twist_func(age, ratio, rng),
-            pitch_func(age, ratio, rng),
-            curve_func(age, ratio, rng),
+            self.twist_func(age, ratio, rng),
+            self.pitch_func(age, ratio, rng),
+            self.curve_func(age, ratio, rng),
         )
-    return inner
 
+    def batch(self, age, ratios, rng):
+        # Returns an array of shape (ratios, 3)
+        return np.stack(
+            [
+                self.twist_func.batch(age, ratios, rng),
+                self.pitch_func.batch(age, ratios, rng),
+                self.curve_func.batch(age, ratios, rng),
+            ],
+            axis=-1,
+        )
+
+
+class SCurvature(BlendingFunction):
+    __slots__ = ('lower_curve', 'higher_curve', 'variation', 'crumple', 'twist', 'age_ratio')
+    random_draws = True
+
+    def __init__(self, lower_curve, higher_curve, variation, crumple, twist, age_ratio):
+        self.lower_curve = lower_curve
+        self.higher_curve = higher_curve
+        self.variation = variation
+        self.crumple = crumple
+        self.twist = twist
+        self.age_ratio = age_ratio
 
-def s_curvature(lower_curve, higher_curve, variation, crumple, twist, age_ratio):
-    def inner(age, ratio, rng):
-        twist_angle = twist(age, ratio, rng)
+    def __call__(self, age, ratio, rng):
+        twist_angle = self.twist(age, ratio, rng)
 
         if ratio <= 0.5:
-            curve = lower_curve
+            curve = self.lower_curve
         else:
-            curve = higher_curve
-        curve += rng.uniform(-1, 1) * variation
-        curve *= age_ratio(age, ratio, rng)
+            curve = self.higher_curve
+        curve += rng.uniform(-1, 1) * self.variation
+        curve *= self.age_ratio(age, ratio, rng)
 
-        pitch = rng.uniform(-1, 1) * crumple
-        pitch *= age_ratio(age, ratio, rng)
+        pitch = rng.uniform(-1, 1) * self.crumple
+        pitch *= self.age_ratio(age, ratio, rng)
         return (twist_angle, pitch, curve)
-    return inner
+
+    def batch(self, age, ratios, rng):
+        # Returns an array of shape (ratios, 3)
+        ratios = np.asarray(ratios, dtype=np.float64)
+        twist_angle = self.twist.batch(age, ratios, rng)
+
+        curve = np.where(ratios <= 0.5, self.lower_curve, self.higher_curve)
+        curve = curve + rng.uniform(-1, 1, ratios.shape) * self.variation
+        curve *= self.age_ratio.batch(age, ratios, rng)
+
+        pitch = rng.uniform(-1, 1, ratios.shape) * self.crumple
+        pitch *= self.age_ratio.batch(age, ratios, rng)
+        return np.stack([twist_angle, pitch, curve], axis=-1)
+
+
+class LinearSplitAngle(BlendingFunction):
+    __slots__ = ('angle_from', 'angle_to', 'angle_variation', 'age_ratio')
+    random_draws = True
+
+    def __init__(self, angle_from, angle_to, angle_variation, age_ratio):
+        self.angle_from = angle_from
+        self.angle_to = angle_to
+        self.angle_variation = angle_variation
+        self.age_ratio = age_ratio
+
+    def __call__(self, age, ratio, rng):
+        angle = self.angle_from + (self.angle_to - self.angle_from) * ratio
+        angle += rng.uniform(-1, 1) * self.angle_variation
+        angle *= self.age_ratio(age, ratio, rng)
+        return angle
+
+    def batch(self, age, ratios, rng):
+        ratios = np.asarray(ratios, dtype=np.float64)
+        angle = self.angle_from + (self.angle_to - self.angle_from) * ratios
+        angle += rng.uniform(-1, 1, ratios.shape) * self.angle_variation
+        angle *= self.age_ratio.batch(age, ratios, rng)
+        return angle
 
 
-def linear_split_angle(angle_from, angle_to, angle_variation, age_ratio):
-    def inner(age, ratio, rng):
-         angle = angle_from + (angle_to - angle_from) * ratio
-         angle += rng.uniform(-1, 1) * angle_variation
-         angle *= age_ratio(age, ratio, rng)
-         return angle
-    return inner
-    
+class ConstantSplittingFunc(BlendingFunction):
+    __slots__ = ('chance', )
+    random_draws = True
 
-def constant_splitting_func(chance):
-    def inner(ratio, accumulator, rng):
-        if rng.random() <= chance:
+    def __init__(self, chance):
+        self.chance = chance
+
+    def __call__(self, ratio, accumulator, rng):
+        if rng.random() <= self.chance:
             splits = 1
         else:
             splits = 0
         return splits, accumulator
-    return inner
 
+    def batch(self, ratios, accumulator, rng):
+        # Returns the array of splits, and the final accumulator.
+        splits = (rng.random(np.shape(ratios)) <= self.chance).astype(np.int64)
+        return splits, accumulator
+
+
+class ErrorSmoothing(BlendingFunction):
+    __slots__ = ('split_chance_func', )
+    random_draws = True
 
-def error_smoothing(split_chance_func):
-    def inner(ratio, accumulator, rng):
-        split_chance = split_chance_func(0, ratio, rng)
+    def __init__(self, split_chance_func):
+        self.split_chance_func = split_chance_func
+
+    def __call__(self, ratio, accumulator, rng):
+        split_chance = self.split_chance_func(0, ratio, rng)
         split_chance_smoothed = split_chance + accumulator
         # We'll consider the number beore the decimal point as the
         # lower limit for the number of splits, and the one after it as
@@ -95,28 +287,88 @@ def error_smoothing(split_chance_func):
         accumulator -= error_correction
 
         return splits, accumulator
-    return inner
 
+    def batch(self, ratios, accumulator, rng):
+        # Returns the array of splits, and the final accumulator. The
+        # error accumulation makes each split depend on the ones before
+        # it, so only the function evaluation and the random draws are
+        # vectorized.
+        split_chances = self.split_chance_func.batch(0, ratios, rng)
+        draws = rng.random(np.shape(ratios))
+        splits = np.empty(np.shape(ratios), dtype=np.int64)
+        for idx, (split_chance, draw) in enumerate(zip(split_chances.tolist(), draws.tolist())):
+            split_chance_smoothed = split_chance + accumulator
+            if draw <= split_chance_smoothed % 1:
+                num_splits = math.ceil(split_chance_smoothed)
+            else:
+                num_splits = max(0, math.floor(split_chance_smoothed))
+            accumulator -= num_splits - split_chance
+            splits[idx] = num_splits
+        return splits, accumulator
+
+
+class EqualSplitRotationFunc(BlendingFunction):
+    __slots__ = ('down_angle_func', 'rotation_noise_magnitude', 'down_angle_noise')
+    random_draws = True
 
-def equal_split_rotation_func(down_angle_func, rotation_noise_magnitude=0.5, down_angle_noise=40.0):
-    def inner(age, ratio, split_idx, num_splits, rng):
+    def __init__(self, down_angle_func, rotation_noise_magnitude=0.5, down_angle_noise=40.0):
+        self.down_angle_func = down_angle_func
+        self.rotation_noise_magnitude = rotation_noise_magnitude
+        self.down_angle_noise = down_angle_noise
+
+    def __call__(self, age, ratio, split_idx, num_splits, rng):
         lobe_angle = 360.0 / num_splits
-        rotation_noise = (rng.random() - 0.5) * rotation_noise_magnitude
+        rotation_noise = (rng.random() - 0.5) * self.rotation_noise_magnitude
         basic_rotation = lobe_angle * (split_idx + rotation_noise)
-        down_angle = down_angle_func(age, ratio, rng) + (rng.random() - 0.5) * 2.0 * down_angle_noise
+        down_angle = self.down_angle_func(age, ratio, rng) + (rng.random() - 0.5) * 2.0 * self.down_angle_noise
         return Vec3(basic_rotation, down_angle, 0)
-    return inner
 
+    def batch(self, age, ratios, split_idxs, nums_splits, rng):
+        # Returns an array of shape (ratios, 3)
+        shape = np.shape(ratios)
+        lobe_angle = 360.0 / np.asarray(nums_splits, dtype=np.float64)
+        rotation_noise = (rng.random(shape) - 0.5) * self.rotation_noise_magnitude
+        basic_rotation = lobe_angle * (split_idxs + rotation_noise)
+        down_angle = self.down_angle_func.batch(age, ratios, rng) + (rng.random(shape) - 0.5) * 2.0 * self.down_angle_noise
+        return np.stack([basic_rotation, down_angle, np.zeros(shape)], axis=-1)
+
+
+class BranchDensity(BlendingFunction):
+    __slots__ = ('ratio_func', )
+
+    def __init__(self, ratio_func):
+        self.ratio_func = ratio_func
+
+    def __call__(self, age, ratio, rng):
+        return self.ratio_func(age, ratio, rng)
+
+    def batch(self, age, ratios, rng):
+        return self.ratio_func.batch(age, ratios, rng)
+
+
+class BranchLengthFunction(BlendingFunction):
+    __slots__ = ('ratio_func', )
 
-def branch_density(ratio_func):
-    def inner(age, ratio, rng):
-        return ratio_func(age, ratio, rng)
-    return inner
+    def __init__(self, ratio_func):
+        self.ratio_func = ratio_func
 
+    def __call__(self, age, ratio, rng):
+        return self.ratio_func(age, ratio, rng)
 
-def branch_length_function(ratio_func):
-    def inner(age, ratio, rng):
-        return ratio_func(age, ratio, rng)
-    return inner
+    def batch(self, age, ratios, rng):
+        return self.ratio_func.batch(age, ratios, rng)
 
 
+# The names under which these have been used in species definitions.
+constant = Constant
+linear = Linear
+noisy_linear_length = NoisyLinearLength
+boring_radius = BoringRadius
+func_curvature = FuncCurvature
+s_curvature = SCurvature
+linear_split_angle = LinearSplitAngle
+constant_splitting_func = ConstantSplittingFunc
+error_smoothing = ErrorSmoothing
+equal_split_rotation_func = EqualSplitRotationFunc
+branch_density = BranchDensity
+branch_length_function = BranchLengthFunction
@@ -0,0 +1,91 @@
+import struct
+import hashlib
+
+import numpy as np
+
+
+# A counter-based random number generator. The n-th number drawn from a
+# generator is a hash of its key and n, so creating one costs nothing,
+# and any number of them can be used independently. Generators for the
+# children of a segment are keyed by the segment's key and the child's
+# index, so the random numbers of a subtree only depend on the path to
+# it from the tree's root, not on the order in which segments are
+# expanded, and subtrees can be generated in any order, or in parallel.
+#
+# `CounterRNG` has the methods of `random.Random` that blending functions
+# use, and when given a `size`, draws arrays like a NumPy `Generator`
+# does; A batch of draws gives the same numbers as the same number of
+# single draws would have.
+
+
+mask = (1 << 64) - 1
+golden_gamma = 0x9e3779b97f4a7c15
+
+
+def mix64(z):
+    # The SplitMix64 finalizer, on Python ints.
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & mask
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & mask
+    return z ^ (z >> 31)
+
+
+def mix64_array(z):
+    # The same on uint64 arrays, which wrap around on overflow.
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+
+def seed_key(seed):
+    # A 64 bit key for any seed that a tree may be given.
+    if isinstance(seed, (bool, int, np.integer)):
+        value = int(seed) & mask
+    elif isinstance(seed, float):
+        value, = struct.unpack('<Q', struct.pack('<d', seed))
+    else:
+        value = int.from_bytes(hashlib.sha256(repr(seed).encode('utf-8')).digest()[:8], 'little')
+    return mix64(value)
+
+
+class CounterRNG:
+    __slots__ = ('key', 'counter')
+
+    def __init__(self, key, counter=0):
+        self.key = key & mask
+        self.counter = counter
+
+    def spawn_key(self, index):
+        # Key for the child generator number `index`; Doesn't draw.
+        return mix64((self.key ^ mix64((index + 1) * golden_gamma & mask)) & mask)
+
+    def spawn(self, index):
+        return CounterRNG(self.spawn_key(index))
+
+    def _next(self):
+        self.counter += 1
+        return mix64((self.key + self.counter * golden_gamma) & mask)
+
+    def _next_array(self, count):
+        counters = np.arange(self.counter + 1, self.counter + count + 1, dtype=np.uint64)
+        self.counter += count
+        return mix64_array(np.uint64(self.key) + counters * np.uint64(golden_gamma))
+
+    def bits(self, size=None):
+        # Raw 64 bit draws.
+        if size is None:
+            return self._next()
+        shape = tuple(np.atleast_1d(size))
+        return self._next_array(int(np.prod(shape, dtype=np.int64))).reshape(shape)
+
+    def random(self, size=None):
+        # Floats in [0, 1).
+        if size is None:
+            return (self._next() >> 11) * (1.0 / (1 << 53))
+        return (self.bits(size) >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return low + (high - low) * self.random(size)
+
+    def randint(self, a, b):
+        # An int in [a, b], like `random.Random.randint`.
+        return a + self._next() % (b - a + 1)
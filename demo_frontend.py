@@ -1,8 +1,8 @@
+import os
 import sys
 import random
 
-from panda3d.core import Vec3
-from panda3d.core import NodePath
+from panda3d.core import GeomNode
 from panda3d.core import KeyboardButton
 from panda3d.core import PointLight
 from panda3d.core import AmbientLight
@@ -10,48 +10,28 @@ from panda3d.core import AmbientLight
 from direct.showbase.ShowBase import ShowBase
 from direct.gui.OnscreenText import OnscreenText
 
-from tree_specs import Segment as sg
 from tree_species import BoringBoringish as BoringTree
-from homebrew import expand_fully
-import geometry
+from forest import TreeJob
+from mesh_cache import MeshCache
+from async_generation import AsyncTreeGenerator
 
 
 def replace_tree(tree_def=BoringTree, seed=None):
     if seed is None:
         seed = random.random()
 
-    global tree_root_1
-    global tree_root_2
     global tree_age
-    tree_root_1.remove_node()
-    tree_root_2.remove_node()
+    global tree_job
 
     rng = random.Random(seed)
 
-    tree_1 = {
-        sg.DEFINITION: BoringTree,
-        sg.RNG_SEED: seed,
-        sg.AGE: tree_age,
-        sg.HELIOTROPIC_DIRECTION: Vec3(0, 0, 1),
-    }
-    expand_fully(tree_1, tropisms=False)
-    tree_geom_node_1 = geometry.trimesh(tree_1)
-
-    tree_2 = {
-        sg.DEFINITION: BoringTree,
-        sg.RNG_SEED: seed,
-        sg.AGE: tree_age,
-        sg.HELIOTROPIC_DIRECTION: Vec3(0, 0, 1),
-    }
-    expand_fully(tree_2, tropisms=True)
-    tree_geom_node_2 = geometry.trimesh(tree_2)
-
-    tree_root_1 = render.attach_new_node(tree_geom_node_1)
-    tree_root_1.set_x(-4)
-    tree_root_2 = render.attach_new_node(tree_geom_node_2)
-    tree_root_2.set_x(4)
-    #tree[sg.TREE_ROOT_NODE].reparent_to(tree_root)
-    #import pdb; pdb.set_trace()
+    # Trees are generated in the background, and replace the old ones
+    # once they are done. Trees that have been seen before are loaded
+    # from the mesh cache.
+    job = TreeJob(BoringTree, seed, tree_age, (0, 0, 1))
+    tree_generator.request(tree_root_1.node(), job, tropisms=False)
+    tree_generator.request(tree_root_2.node(), job, tropisms=True)
+    tree_job = job
 
 
 def move_camera(task):
@@ -81,9 +61,18 @@ def move_camera(task):
 
 def change_tree_age(delta):
     global tree_age
+    global tree_job
     tree_age += delta
     text_age['text'] = str(tree_age)
 
+    # The trees are regrown in the background, and in place where
+    # possible.
+    if tree_job is None:
+        return
+    tree_job = tree_job._replace(age=tree_age)
+    for tree_root, tropisms in [(tree_root_1, False), (tree_root_2, True)]:
+        tree_generator.request(tree_root.node(), tree_job, tropisms=tropisms, in_place=True)
+
 
 # Actual application
 
@@ -93,10 +82,16 @@ ShowBase()
 global tree_root_1
 global tree_root_2
 global tree_age
+global tree_job
 global text_age
-tree_root_1 = render.attach_new_node('empty')
-tree_root_2 = render.attach_new_node('empty')
+tree_root_1 = render.attach_new_node(GeomNode('tree_1'))
+tree_root_1.set_x(-4)
+tree_root_2 = render.attach_new_node(GeomNode('tree_2'))
+tree_root_2.set_x(4)
 tree_age = 1.0
+tree_job = None
+mesh_cache = MeshCache(os.path.join(os.path.expanduser('~'), '.cache', 'panda3d-trees'))
+tree_generator = AsyncTreeGenerator(base.task_mgr, mesh_cache=mesh_cache)
 text_age = OnscreenText(text=str(tree_age), pos=(-0.9, 0.9), scale=0.07)
 
 
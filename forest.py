@@ -0,0 +1,107 @@
+import os
+import random
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from panda3d.core import Vec3
+
+from tree_specs import Segment as sg
+from homebrew import expand_fully
+from segment_store import SegmentStore
+import tree_species
+import geometry
+
+
+# Generating many trees at once. Each tree is described by a job, and
+# depends on nothing but that job, so the trees can be generated in any
+# process, in any order, and the result stays the same. Workers return
+# the raw vertex and index buffers, which are turned into GeomNodes in
+# the calling process.
+
+
+# species: A StemDefinition dict, or the name of one in `tree_species`.
+# seed: RNG_SEED of the tree's root segment.
+# age: AGE of the tree.
+# heliotropic_direction: HELIOTROPIC_DIRECTION of the tree.
+TreeJob = namedtuple('TreeJob', 'species seed age heliotropic_direction')
+TreeJob.__new__.__defaults__ = (1.0, (0, 0, 1))
+
+
+def tree_seeds(forest_seed, count):
+    # Deterministic per-tree seeds for a forest.
+    rng = random.Random(forest_seed)
+    return [rng.randint(0, 2**31 - 1) for _ in range(count)]
+
+
+def resolve_species(species):
+    if isinstance(species, str):
+        return getattr(tree_species, species)
+    return species
+
+
+def job_tree(job):
+    # The unexpanded root segment of the job's tree.
+    return {
+        sg.DEFINITION: resolve_species(job.species),
+        sg.RNG_SEED: job.seed,
+        sg.AGE: job.age,
+        sg.HELIOTROPIC_DIRECTION: Vec3(*job.heliotropic_direction),
+    }
+
+
+def expand_job(job, tropisms=True):
+    store = SegmentStore()
+    expand_fully(job_tree(job), tropisms=tropisms, scene_graph=False, store=store)
+    return store
+
+
+def tree_buffers(job, tropisms=True, circle_segments=10, bark_tris=True):
+    # Runs in the worker processes; Returns the vertex and index data
+    # as bytes, which are cheap to send back.
+    store = expand_job(job, tropisms=tropisms)
+    rings = geometry.gather_rings(store)
+    vertices = geometry.ring_vertices(rings, circle_segments)
+    indices = geometry.bark_indices(rings, circle_segments, bark_tris)
+    return vertices.tobytes(), indices.astype(np.uint32).tobytes()
+
+
+def _tree_buffers(args):
+    job, tropisms, circle_segments, bark_tris = args
+    return tree_buffers(job, tropisms, circle_segments, bark_tris)
+
+
+def buffers_to_geom_node(buffers, bark_tris=True, name='geom_node'):
+    vertex_bytes, index_bytes = buffers
+    vertices = np.frombuffer(vertex_bytes, dtype=geometry.vertex_dtype)
+    indices = np.frombuffer(index_bytes, dtype=np.uint32)
+    return geometry.make_geom_node(vertices, indices, bark_tris, name=name)
+
+
+def generate_forest_buffers(jobs, max_workers=None, tropisms=True, circle_segments=10, bark_tris=True):
+    # With `max_workers=0`, everything is done in this process.
+    jobs = [TreeJob(*job) for job in jobs]
+    args = [(job, tropisms, circle_segments, bark_tris) for job in jobs]
+    if max_workers == 0:
+        return [_tree_buffers(a) for a in args]
+
+    workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(args) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_tree_buffers, args, chunksize=chunksize))
+
+
+def generate_forest(jobs, max_workers=None, tropisms=True, circle_segments=10, bark_tris=True):
+    # Returns one GeomNode per job, in the order of the jobs.
+    all_buffers = generate_forest_buffers(
+        jobs,
+        max_workers=max_workers,
+        tropisms=tropisms,
+        circle_segments=circle_segments,
+        bark_tris=bark_tris,
+    )
+    return [
+        buffers_to_geom_node(buffers, bark_tris, name='tree_{}'.format(idx))
+        for idx, buffers in enumerate(all_buffers)
+    ]
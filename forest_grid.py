@@ -0,0 +1,96 @@
+import math
+
+from panda3d.core import NodePath
+
+
+# A container for the trees of a large scene. Trees are bucketed into
+# square cells of a grid, and each cell is shown as one flattened node,
+# so the culler can reject a whole cell by its bounds without looking at
+# its trees, and a cell costs few draw calls. Adding and removing trees
+# only marks their cells as dirty; `flush` rebuilds the dirty cells, and
+# can be run as a task.
+
+
+class ForestGrid:
+    def __init__(self, parent, cell_size=64.0, name='forest_grid'):
+        self.root = parent.attach_new_node(name)
+        self.cell_size = cell_size
+        self.cells = {}       # cell -> {handle: tree NodePath}
+        self.cell_nodes = {}  # cell -> flattened NodePath under `root`
+        self.tree_cells = {}  # handle -> cell
+        self.dirty = set()
+        self._next_handle = 0
+
+    def cell_of(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def add(self, node, pos, hpr=(0, 0, 0), scale=1.0):
+        # Places the (Geom)Node `node` at `pos`, and returns a handle for
+        # removing it again. The node itself is not modified, so the same
+        # one can be added many times.
+        tree = NodePath('tree')
+        NodePath(node).copy_to(tree)
+        tree.set_pos_hpr_scale(pos, hpr, scale)
+        cell = self.cell_of(pos[0], pos[1])
+        handle = self._next_handle
+        self._next_handle += 1
+        self.cells.setdefault(cell, {})[handle] = tree
+        self.tree_cells[handle] = cell
+        self.dirty.add(cell)
+        return handle
+
+    def remove(self, handle):
+        cell = self.tree_cells.pop(handle)
+        del self.cells[cell][handle]
+        if not self.cells[cell]:
+            del self.cells[cell]
+        self.dirty.add(cell)
+
+    def remove_area(self, x_min, y_min, x_max, y_max):
+        # Removes all trees standing within the rectangle, e.g. when a
+        # chunk of terrain is streamed out. Returns their handles.
+        low = self.cell_of(x_min, y_min)
+        high = self.cell_of(x_max, y_max)
+        removed = []
+        for cell_x in range(low[0], high[0] + 1):
+            for cell_y in range(low[1], high[1] + 1):
+                for handle, tree in list(self.cells.get((cell_x, cell_y), {}).items()):
+                    pos = tree.get_pos()
+                    if x_min <= pos.x <= x_max and y_min <= pos.y <= y_max:
+                        self.remove(handle)
+                        removed.append(handle)
+        return removed
+
+    def _build_cell(self, cell):
+        cell_node = NodePath('cell_{}_{}'.format(*cell))
+        for tree in self.cells[cell].values():
+            tree.copy_to(cell_node)
+        cell_node.flatten_strong()
+        return cell_node
+
+    def flush(self):
+        # Rebuilds the dirty cells. Each old cell node is replaced in one
+        # step, so no frame shows a cell half built.
+        for cell in self.dirty:
+            old_node = self.cell_nodes.pop(cell, None)
+            if cell in self.cells:
+                cell_node = self._build_cell(cell)
+                cell_node.reparent_to(self.root)
+                self.cell_nodes[cell] = cell_node
+            if old_node is not None:
+                old_node.remove_node()
+        self.dirty = set()
+
+    def update(self, task):
+        self.flush()
+        return task.cont
+
+    def __len__(self):
+        return len(self.tree_cells)
+
+    def destroy(self):
+        self.root.remove_node()
+        self.cells = {}
+        self.cell_nodes = {}
+        self.tree_cells = {}
+        self.dirty = set()
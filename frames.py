@@ -0,0 +1,169 @@
+from panda3d.core import Vec3
+from panda3d.core import Point3
+from panda3d.core import Mat4
+from panda3d.core import Quat
+
+
+# A Frame is a stand-in for the per-segment NodePaths that `homebrew`
+# creates. It stores the local position and orientation of a segment
+# relative to its parent, and accumulates them along the parent chain
+# into a 4x4 matrix relative to the tree's root, without ever touching
+# the scene graph. It implements just the part of the NodePath API that
+# the expansion stages use, with the same semantics, so that the stages
+# work on either.
+#
+# The net matrix of a frame is cached once it has been asked for. This
+# is fine for tree expansion, as a segment's transform is final before
+# its continuations and branches are expanded. While a segment is being
+# oriented, the stages convert vectors between it and its parent, which
+# only needs its local matrix; Those conversions don't compute any net
+# matrices that the next `set_*` would throw away again. Frames only
+# have positions and rotations, so their matrices are inverted as
+# affine ones.
+
+
+class Frame:
+    __slots__ = ('name', 'parent', 'pos', 'hpr', '_local_mat', '_net_mat', '_inv_net_mat')
+
+    def __init__(self, name='frame', parent=None):
+        self.name = name
+        self.parent = parent
+        self.pos = Vec3(0, 0, 0)
+        self.hpr = Vec3(0, 0, 0)
+        self._local_mat = None
+        self._net_mat = None
+        self._inv_net_mat = None
+
+    def attach_new_node(self, name):
+        return Frame(name, parent=self)
+
+    def _changed(self):
+        self._local_mat = None
+        self._net_mat = None
+        self._inv_net_mat = None
+
+    def _moved(self):
+        # Only the position changed, so the local matrix can keep its
+        # rotation.
+        if self._local_mat is not None:
+            self._local_mat.set_row(3, self.pos)
+        self._net_mat = None
+        self._inv_net_mat = None
+
+    # Matrices
+
+    def get_local_mat(self):
+        # Composed directly, without going through a (cached, shared)
+        # TransformState.
+        if self._local_mat is None:
+            rotation = Quat()
+            rotation.set_hpr(self.hpr)
+            self._local_mat = Mat4()
+            rotation.extract_to_matrix(self._local_mat)
+            self._local_mat.set_row(3, self.pos)
+        return self._local_mat
+
+    def get_net_mat(self):
+        """Matrix from this frame's space to the root frame's space."""
+        if self._net_mat is None:
+            if self.parent is None:
+                self._net_mat = Mat4(self.get_local_mat())
+            else:
+                self._net_mat = self.get_local_mat() * self.parent.get_net_mat()
+        return self._net_mat
+
+    def get_inv_net_mat(self):
+        if self._inv_net_mat is None:
+            self._inv_net_mat = Mat4()
+            self._inv_net_mat.invert_affine_from(self.get_net_mat())
+        return self._inv_net_mat
+
+    def _relative_mat(self, other):
+        # Matrix from `other`'s space into this frame's.
+        if other.parent is self:
+            return other.get_local_mat()
+        if self.parent is other:
+            inv_local_mat = Mat4()
+            inv_local_mat.invert_affine_from(self.get_local_mat())
+            return inv_local_mat
+        return other.get_net_mat() * self.get_inv_net_mat()
+
+    def get_mat(self, other=None):
+        """Like NodePath.get_mat(); `other` defaults to the parent."""
+        if other is None:
+            return Mat4(self.get_local_mat())
+        return self.get_net_mat() * other.get_inv_net_mat()
+
+    # Orientation
+
+    def get_h(self):
+        return self.hpr.x
+
+    def get_p(self):
+        return self.hpr.y
+
+    def get_r(self):
+        return self.hpr.z
+
+    def get_hpr(self):
+        return Vec3(self.hpr)
+
+    def set_h(self, h):
+        self.hpr = Vec3(h, self.hpr.y, self.hpr.z)
+        self._changed()
+
+    def set_p(self, p):
+        self.hpr = Vec3(self.hpr.x, p, self.hpr.z)
+        self._changed()
+
+    def set_r(self, r):
+        self.hpr = Vec3(self.hpr.x, self.hpr.y, r)
+        self._changed()
+
+    def set_hpr(self, *args):
+        self.hpr = Vec3(*args)
+        self._changed()
+
+    # Position
+
+    def get_pos(self, other=None):
+        if other is None:
+            return Point3(self.pos)
+        if other is self:
+            return Point3(0, 0, 0)
+        return self.get_mat(other).xform_point(Point3(0, 0, 0))
+
+    def set_pos(self, *args):
+        if isinstance(args[0], Frame):
+            other, pos = args[0], Point3(*args[1:])
+            if other is self:
+                pos = self.get_local_mat().xform_point(pos)
+            elif other is not self.parent:
+                pos = other.get_net_mat().xform_point(pos)
+                if self.parent is not None:
+                    pos = self.parent.get_inv_net_mat().xform_point(pos)
+        else:
+            pos = Point3(*args)
+        self.pos = Vec3(pos)
+        self._moved()
+
+    def set_z(self, *args):
+        if len(args) == 2:
+            other, z = args
+            pos = self.get_pos(other)
+            self.set_pos(other, pos.x, pos.y, z)
+        else:
+            self.set_pos(self.pos.x, self.pos.y, args[0])
+
+    # Conversions between frames
+
+    def get_relative_vector(self, other, vec):
+        """Converts `vec` from `other`'s space into this frame's."""
+        if other is self:
+            return Vec3(vec)
+        return self._relative_mat(other).xform_vec(vec)
+
+    def get_relative_point(self, other, point):
+        if other is self:
+            return Point3(point)
+        return self._relative_mat(other).xform_point(point)
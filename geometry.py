@@ -1,12 +1,20 @@
 import math
 import random
 import enum
+import functools
+from collections import namedtuple
+
+import numpy as np
 
 from panda3d.core import Vec3
 from panda3d.core import Vec4
 from panda3d.core import VBase4
 from panda3d.core import LineSegs
 from panda3d.core import GeomVertexFormat
+from panda3d.core import GeomVertexArrayFormat
+from panda3d.core import InternalName
+from panda3d.core import Shader
+from panda3d.core import TextureStage
 from panda3d.core import GeomVertexData
 from panda3d.core import GeomVertexWriter
 from panda3d.core import GeomTriangles
@@ -17,18 +25,39 @@ from panda3d.core import NodePath
 
 from tree_specs import StemDefinition as sd
 from tree_specs import Segment as sg
+from segment_store import SegmentStore
+from segment_store import store_from_tree
+from homebrew import expand_iter
+from frames import Frame
 
 
 class GeometryData(enum.Enum):
     FOOT_RING_START_VERTEX = 1  # 
     TOP_RING_START_VERTEX  = 2  # 
     TWIST_ANGLE            = 3  # Heading accumulated throuugh stem splitting.
+    TOP_RING               = 4  # Index of the segment's top ring in the gathered ring arrays.
+    CHUNK                  = 5  # Number of the mesh chunk that the segment's top ring is in.
 
 
 gd = GeometryData
 
 
-def trimesh(stem, circle_segments=10, bark_tris=True):
+class VertexFormat(enum.Enum):
+    DEBUG   = 1  # Vertex, normal, and a color showing the segments; `vertex_dtype`
+    BARK    = 2  # Vertex, normal, bark UVs, tangent and binormal, all floats; `bark_vertex_dtype`
+    COMPACT = 3  # Vertex, bark UVs, and normal and tangent packed into bytes; `compact_vertex_dtype`
+
+
+def trimesh(stem, circle_segments=10, bark_tris=True, wind=False, vertex_format=VertexFormat.DEBUG):
+    # Trees expanded with `scene_graph=False` have no NodePaths for the
+    # turtle below to move around in, so they are always batched.
+    batched = (
+        isinstance(stem, SegmentStore) or
+        isinstance(stem[sg.TREE_ROOT][sg.TREE_ROOT_NODE], Frame)
+    )
+    if batched or wind or vertex_format != VertexFormat.DEBUG:
+        return batched_trimesh(stem, circle_segments, bark_tris, wind=wind, vertex_format=vertex_format)
+
     segments = [stem]
     current_vertex_count = 0
 
@@ -125,9 +154,9 @@ def trimesh(stem, circle_segments=10, bark_tris=True):
         segments += s[sg.CONTINUATIONS]
         segments += s[sg.BRANCHES]
 
-    # Now we go through all the segments again to connect the vertex
-    # rings into meshes.
-    tris = GeomTriangles(Geom.UHStatic)
+    # Now we go through all the segments again to find which rings to
+    # connect into meshes, and connect them all in one go.
+    connections = []
 
     segments = [stem]
     while segments:
@@ -139,32 +168,750 @@ def trimesh(stem, circle_segments=10, bark_tris=True):
             parent_start_index = s[gd.FOOT_RING_START_VERTEX]
         else:
             parent_start_index = s[sg.PARENT_SEGMENT][gd.TOP_RING_START_VERTEX]
-
-        for i in range(circle_segments):
-            v_tl = own_start_index + i
-            v_bl = parent_start_index + i
-            v_tr = own_start_index + (i + 1) % circle_segments
-            v_br = parent_start_index + (i + 1) % circle_segments
-
-            if bark_tris:
-                tris.addVertices(v_tl, v_bl, v_tr)
-                tris.addVertices(v_br, v_tr, v_bl)
-            else:
-                lines = GeomLines(Geom.UHStatic)
-                lines.addVertices(v_tl, v_bl)
-                lines.closePrimitive()
-                geom.addPrimitive(lines)
-                lines.addVertices(v_tr, v_br)
-                lines.closePrimitive()
-                geom.addPrimitive(lines)
+        connections.append((own_start_index // circle_segments, parent_start_index // circle_segments))
 
         segments += s[sg.CONTINUATIONS]
         segments += s[sg.BRANCHES]
 
-    tris.closePrimitive()
-    geom.addPrimitive(tris)
+    connections = np.array(connections, dtype=np.int64).reshape(-1, 2)
+    indices = connection_indices(connections, circle_segments, bark_tris, current_vertex_count)
+    geom.addPrimitive(make_primitive(indices, bark_tris))
 
     # ...and now we pack it up all neat and tidy.
     node = GeomNode('geom_node')
     node.add_geom(geom)
     return node
+
+
+# Batched mesh building
+#
+# Instead of moving a turtle NodePath around, `batched_trimesh` walks the
+# tree once to gather the frame of every vertex ring, computes all ring
+# vertices in one go with NumPy, and copies the result into the
+# GeomVertexData and GeomTriangles in one memoryview copy each. It
+# produces the same vertices in the same order as `trimesh`.
+
+vertex_dtype = np.dtype(
+    [
+        ('vertex', '<f4', 3),
+        ('normal', '<f4', 3),
+        ('color', 'u1', 4),
+    ],
+)
+
+
+# mats: (rings, 4, 4) matrices from ring space to tree root space
+# radii, z_offsets, twists, rest_segments: (rings, ) per-ring parameters
+# connections: (segments, 2) indices of each segment's top and bottom ring
+Rings = namedtuple('Rings', 'mats radii z_offsets twists rest_segments connections')
+
+
+def _mat_row_major(mat):
+    return [*mat.get_row(0), *mat.get_row(1), *mat.get_row(2), *mat.get_row(3)]
+
+
+_identity = [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+
+
+class RingCollector:
+    # Collects the vertex rings of segments, which have to be added
+    # parents first. When a mesh is built in several chunks, a segment
+    # whose parent's top ring went into an earlier chunk gets a copy of
+    # that ring to connect to.
+    def __init__(self, chunk=0):
+        self.chunk = chunk
+        self.mats = []
+        self.radii = []
+        self.z_offsets = []
+        self.twists = []
+        self.rest_segments = []
+        self.connections = []
+
+    def __len__(self):
+        return len(self.mats)
+
+    def add_ring(self, s, mat, z_offset, twist):
+        self.mats.append(mat)
+        self.radii.append(s[sg.RADIUS])
+        self.z_offsets.append(z_offset)
+        self.twists.append(twist)
+        self.rest_segments.append(s[sg.REST_SEGMENTS])
+        return len(self.mats) - 1
+
+    def add_segment(self, s, root_node):
+        mat = _mat_row_major(s[sg.NODE].get_mat(root_node))
+
+        # Stem roots get a foot ring, and are untwisted; Other segments
+        # connect to their parent's top ring, and untwist the heading
+        # that they have accumulated.
+        if sg.TREE_ROOT_NODE in s:
+            twist = 0.0
+            bottom_ring = self.add_ring(s, _identity, 0.0, twist)
+        elif sg.IS_NEW_BRANCH in s:
+            twist = 0.0
+            bottom_ring = self.add_ring(s, mat, -s[sg.LENGTH], twist)
+        else:
+            parent = s[sg.PARENT_SEGMENT]
+            twist = parent[gd.TWIST_ANGLE] + s[sg.NODE].get_h()
+            if parent[gd.CHUNK] == self.chunk:
+                bottom_ring = parent[gd.TOP_RING]
+            else:
+                parent_mat = _mat_row_major(parent[sg.NODE].get_mat(root_node))
+                bottom_ring = self.add_ring(parent, parent_mat, 0.0, parent[gd.TWIST_ANGLE])
+        s[gd.TWIST_ANGLE] = twist
+        s[gd.TOP_RING] = self.add_ring(s, mat, 0.0, twist)
+        s[gd.CHUNK] = self.chunk
+        self.connections.append((s[gd.TOP_RING], bottom_ring))
+
+    def rings(self):
+        return Rings(
+            mats=np.array(self.mats, dtype=np.float32).reshape(-1, 4, 4),
+            radii=np.array(self.radii, dtype=np.float32),
+            z_offsets=np.array(self.z_offsets, dtype=np.float32),
+            twists=np.array(self.twists, dtype=np.float32),
+            rest_segments=np.array(self.rest_segments, dtype=np.int64),
+            connections=np.array(self.connections, dtype=np.uint32).reshape(-1, 2),
+        )
+
+
+def gather_rings(stem):
+    if isinstance(stem, SegmentStore):
+        return store_rings(stem)
+
+    root_node = stem[sg.TREE_ROOT_NODE]
+    collector = RingCollector()
+    segments = [stem]
+    while segments:
+        s = segments.pop()
+        collector.add_segment(s, root_node)
+        segments += s[sg.CONTINUATIONS]
+        segments += s[sg.BRANCHES]
+    return collector.rings()
+
+
+def store_rings(store):
+    # The same as `gather_rings`, but without walking the tree, since
+    # the store already has all the data in arrays in the right order.
+    stem_root = store.is_stem_root()
+    tree_root = store.parent == -1
+    rings_per_segment = 1 + stem_root
+    first_ring = np.cumsum(rings_per_segment) - rings_per_segment
+    top_ring = first_ring + stem_root
+    bottom_ring = np.where(stem_root, first_ring, top_ring[store.parent])
+
+    num_rings = first_ring[-1] + rings_per_segment[-1]
+    mats = np.empty((num_rings, 4, 4), dtype=np.float32)
+    mats[top_ring] = store.transform
+    mats[first_ring[stem_root]] = store.transform[stem_root]
+    mats[first_ring[tree_root]] = np.identity(4, dtype=np.float32)
+    z_offsets = np.zeros(num_rings, dtype=np.float32)
+    z_offsets[first_ring[stem_root]] = -store.length[stem_root]
+    z_offsets[first_ring[tree_root]] = 0.0
+    # Feet and tops of segments share all the other parameters.
+    segment_of_ring = np.repeat(np.arange(len(store)), rings_per_segment)
+
+    return Rings(
+        mats=mats,
+        radii=store.radius[segment_of_ring],
+        z_offsets=z_offsets,
+        twists=store.twist[segment_of_ring],
+        rest_segments=store.rest_segments[segment_of_ring].astype(np.int64),
+        connections=np.stack([top_ring, bottom_ring], axis=-1).astype(np.uint32),
+    )
+
+
+def _ring_headings(rings, circle_segments=10, seam=False):
+    # With `seam`, each ring gets an extra vertex at the end, in the
+    # same place as its first one.
+    num_columns = circle_segments + 1 if seam else circle_segments
+    headings = (
+        360.0 / circle_segments * np.arange(num_columns)[np.newaxis, :] -
+        rings.twists[:, np.newaxis]
+    )
+    return np.sin(np.radians(headings)), np.cos(np.radians(headings))
+
+
+def _ring_points(rings, sin_h, cos_h):
+    # Points and normals in ring space, as row vectors...
+    num_rings, num_columns = sin_h.shape
+    local_points = np.empty((num_rings, num_columns, 4), dtype=np.float32)
+    local_points[:, :, 0] = -sin_h * rings.radii[:, np.newaxis]
+    local_points[:, :, 1] = cos_h * rings.radii[:, np.newaxis]
+    local_points[:, :, 2] = rings.z_offsets[:, np.newaxis]
+    local_points[:, :, 3] = 1.0
+    local_normals = np.zeros((num_rings, num_columns, 4), dtype=np.float32)
+    local_normals[:, :, 0] = -sin_h
+    local_normals[:, :, 1] = cos_h
+
+    # ...transformed into the tree root's space.
+    points = np.matmul(local_points, rings.mats)[:, :, :3]
+    normals = np.matmul(local_normals, rings.mats)[:, :, :3]
+    return points, normals
+
+
+def ring_vertices(rings, circle_segments=10):
+    num_rings = len(rings.radii)
+    sin_h, cos_h = _ring_headings(rings, circle_segments)
+    vertices = np.empty((num_rings, circle_segments), dtype=vertex_dtype)
+    vertices['vertex'], vertices['normal'] = _ring_points(rings, sin_h, cos_h)
+    rest = rings.rest_segments[:, np.newaxis]
+    colors = np.stack(
+        [rest % 2, rest % 4 // 2, rest % 8 // 4, np.ones_like(rest)],
+        axis=-1,
+    )
+    vertices['color'] = colors * 255
+    return vertices.reshape(-1)
+
+
+def index_dtype(num_vertices):
+    # 16 bit indices where they suffice; 0xffff is left out, as Panda3D
+    # uses it to cut strips.
+    if num_vertices < 0xffff:
+        return np.dtype(np.uint16)
+    return np.dtype(np.uint32)
+
+
+@functools.lru_cache()
+def quad_pattern(circle_segments, bark_tris=True, seam=False):
+    # The indices connecting two rings, as which ring (0 for the top, 1
+    # for the bottom one) and which vertex in it each index refers to.
+    # The same for every connection, so it is only made once. Triangles
+    # go [top left, bottom left, top right, bottom right, top right,
+    # bottom left] around the rings. Lines only go [top left, bottom
+    # left], since each quad's right edge is the next one's left edge.
+    # With `seam`, the last quad ends on the extra vertex at the end of
+    # the ring instead of wrapping around.
+    i = np.arange(circle_segments)
+    if seam:
+        i_next = i + 1
+    else:
+        i_next = (i + 1) % circle_segments
+    if bark_tris:
+        ring = np.array([0, 1, 0, 1, 0, 1])
+        vertex = np.stack([i, i, i_next, i_next, i_next, i], axis=-1)
+    else:
+        ring = np.array([0, 1])
+        vertex = np.stack([i, i], axis=-1)
+    ring = np.broadcast_to(ring, vertex.shape).ravel()
+    vertex = vertex.ravel()
+    ring.setflags(write=False)
+    vertex.setflags(write=False)
+    return ring, vertex
+
+
+def connection_indices(connections, circle_segments=10, bark_tris=True, num_vertices=None, seam=False):
+    # Indices for (segments, 2) pairs of connected top and bottom rings;
+    # 16 bit if `num_vertices` allows.
+    dtype = np.dtype(np.uint32) if num_vertices is None else index_dtype(num_vertices)
+    ring, vertex = quad_pattern(circle_segments, bark_tris, seam)
+    ring_size = circle_segments + 1 if seam else circle_segments
+    ring_starts = connections.astype(dtype) * dtype.type(ring_size)
+    return (ring_starts[:, ring] + vertex.astype(dtype)).ravel()
+
+
+def bark_indices(rings, circle_segments=10, bark_tris=True, seam=False):
+    ring_size = circle_segments + 1 if seam else circle_segments
+    num_vertices = len(rings.radii) * ring_size
+    return connection_indices(rings.connections, circle_segments, bark_tris, num_vertices, seam)
+
+
+def make_primitive(indices, bark_tris=True):
+    # A single GeomTriangles or GeomLines with all of `indices`, in the
+    # index type that matches their dtype.
+    if bark_tris:
+        prim = GeomTriangles(Geom.UHStatic)
+    else:
+        prim = GeomLines(Geom.UHStatic)
+    if indices.dtype == np.uint16:
+        prim.set_index_type(Geom.NT_uint16)
+    else:
+        prim.set_index_type(Geom.NT_uint32)
+    index_array = prim.modify_vertices()
+    index_array.unclean_set_num_rows(len(indices))
+    memoryview(index_array).cast('B')[:] = np.ascontiguousarray(indices).view(np.uint8)
+    return prim
+
+
+def make_geom_node(vertices, indices, bark_tris=True, name='geom_node'):
+    if vertices.dtype == wind_vertex_dtype:
+        vformat = wind_vertex_format()
+    elif vertices.dtype == bark_vertex_dtype:
+        vformat = bark_vertex_format()
+    elif vertices.dtype == compact_vertex_dtype:
+        vformat = compact_vertex_format()
+    else:
+        vformat = GeomVertexFormat.getV3n3c4()
+    vdata = GeomVertexData("Data", vformat, Geom.UHDynamic)
+    vdata.unclean_set_num_rows(len(vertices))
+    memoryview(vdata.modify_array(0)).cast('B')[:] = vertices.view(np.uint8)
+
+    # Indices are stored in 16 bits where the vertex count allows.
+    indices = np.asarray(indices).astype(index_dtype(len(vertices)), copy=False)
+    geom = Geom(vdata)
+    geom.add_primitive(make_primitive(indices, bark_tris))
+    node = GeomNode(name)
+    node.add_geom(geom)
+    return node
+
+
+def geom_indices(geom):
+    prim = geom.get_primitive(0)
+    if prim.get_index_type() == Geom.NT_uint16:
+        dtype = np.uint16
+    else:
+        dtype = np.uint32
+    return np.frombuffer(memoryview(prim.get_vertices()).cast('B'), dtype=dtype)
+
+
+def update_geom_node(node, vertices, indices, bark_tris=True):
+    # If the mesh has the same vertex count and triangles as the one in
+    # `node` (as made by `make_geom_node`), its vertices are rewritten
+    # in place; Otherwise the Geom is replaced. Returns whether the
+    # update happened in place.
+    if node.get_num_geoms() == 0:
+        node.add_geom(make_geom_node(vertices, indices, bark_tris).modify_geom(0))
+        return False
+    geom = node.modify_geom(0)
+    vdata = geom.modify_vertex_data()
+    old_indices = geom_indices(geom)
+    if vdata.get_num_rows() == len(vertices) and np.array_equal(old_indices, indices):
+        memoryview(vdata.modify_array(0)).cast('B')[:] = vertices.view(np.uint8)
+        return True
+    new_node = make_geom_node(vertices, indices, bark_tris)
+    node.set_geom(0, new_node.modify_geom(0))
+    return False
+
+
+def batched_trimesh(stem, circle_segments=10, bark_tris=True, wind=False, vertex_format=VertexFormat.DEBUG):
+    # With `wind`, the vertices also get the data for `wind_shader`.
+    # Other vertex formats than `VertexFormat.DEBUG` carry bark UVs and
+    # tangents instead of debug colors, and can't sway in the wind.
+    if wind and vertex_format != VertexFormat.DEBUG:
+        raise ValueError("Wind needs the debug vertex format, not {}".format(vertex_format))
+    textured = vertex_format != VertexFormat.DEBUG
+    if (wind or textured) and not isinstance(stem, SegmentStore):
+        stem = store_from_tree(stem)
+    rings = gather_rings(stem)
+    if textured:
+        vertices = bark_vertices(
+            rings,
+            store_bark_v(stem),
+            circle_segments,
+            compact=vertex_format == VertexFormat.COMPACT,
+        )
+    else:
+        vertices = ring_vertices(rings, circle_segments)
+    if wind:
+        vertices = wind_vertices(vertices, store_wind_data(stem), circle_segments)
+    indices = bark_indices(rings, circle_segments, bark_tris, seam=textured)
+    return make_geom_node(vertices, indices, bark_tris)
+
+
+# Wind
+#
+# To let trees sway on the GPU, each vertex carries where it is in the
+# tree's hierarchy. `wind_shader` bends the whole tree with height, and
+# each stem in proportion to the distance along it, thin ones more, and
+# faster. A stem also has to move along with the point on its parent
+# where it sprouts, which moves with the grandparent, and so on, so each
+# vertex carries the sway of its whole chain of stems: In
+# `sway_amplitude`, per stem level from 1 to 4, the flexibility times
+# the distance along the stem (at the vertex for the vertex's own stem,
+# and at the sprouting point for the stems it grows on), and in
+# `sway_phase`, a phase that differs from stem to stem. The trunk only
+# bends with the tree, and stems beyond level 4 only sway along with
+# their parents. `pivot` is the foot of the vertex's own stem.
+
+max_sway_levels = 4
+
+wind_vertex_dtype = np.dtype(
+    [
+        ('vertex', '<f4', 3),
+        ('normal', '<f4', 3),
+        ('color', 'u1', 4),
+        ('pivot', '<f4', 3),
+        ('sway_amplitude', '<f4', max_sway_levels),
+        ('sway_phase', '<f4', max_sway_levels),
+    ],
+)
+
+
+_wind_vertex_format = None
+
+
+def wind_vertex_format():
+    global _wind_vertex_format
+    if _wind_vertex_format is None:
+        array_format = GeomVertexArrayFormat(GeomVertexFormat.getV3n3c4().get_array(0))
+        array_format.add_column(InternalName.make('pivot'), 3, Geom.NT_float32, Geom.C_point)
+        array_format.add_column(InternalName.make('sway_amplitude'), max_sway_levels, Geom.NT_float32, Geom.C_other)
+        array_format.add_column(InternalName.make('sway_phase'), max_sway_levels, Geom.NT_float32, Geom.C_other)
+        _wind_vertex_format = GeomVertexFormat.register_format(array_format)
+    return _wind_vertex_format
+
+
+def store_ring_segments(store):
+    # For each ring, in the order of `store_rings`, the segment it
+    # belongs to, and whether it is the foot ring of a stem.
+    stem_root = store.is_stem_root()
+    rings_per_segment = 1 + stem_root
+    segment_of_ring = np.repeat(np.arange(len(store)), rings_per_segment)
+    is_foot = np.zeros(len(segment_of_ring), dtype=bool)
+    is_foot[(np.cumsum(rings_per_segment) - rings_per_segment)[stem_root]] = True
+    return segment_of_ring, is_foot
+
+
+def stem_distances(store):
+    # Distance from the foot of the stem to the top of each segment
+    stem_root = store.is_stem_root()
+    distance = np.empty(len(store), dtype=np.float32)
+    lengths = store.length.tolist()
+    parents = store.parent.tolist()
+    for idx, is_root in enumerate(stem_root.tolist()):
+        distance[idx] = lengths[idx] + (0.0 if is_root else distance[parents[idx]])
+    return distance
+
+
+def store_wind_data(store):
+    # Per ring, in the order of `store_rings`: The pivot, and the sway
+    # amplitudes and phases.
+    stem_root = store.is_stem_root()
+    distance = stem_distances(store)
+    feet = store.transform[:, 3, :3] - store.transform[:, 2, :3] * store.length[:, np.newaxis]
+    feet[store.parent == -1] = 0.0
+    stiffness = np.clip(store.radius / max(store.root_radius, 1e-6), 0.0, 1.0)
+    # The amplitude of each segment's top ring in its own stem's slot,
+    # and of the ring below it.
+    top_amplitude = (1.0 - stiffness) * distance
+    bottom_amplitude = np.zeros(len(store), dtype=np.float32)
+    bottom_amplitude[~stem_root] = top_amplitude[store.parent[~stem_root]]
+    phase = (store.stem * 0.618034) % 1.0 * 2.0 * np.pi
+    slot = store.level.astype(np.int64) - 1
+    has_slot = (slot >= 0) & (slot < max_sway_levels)
+
+    # The sway of the stems that each stem grows on, at the point where
+    # it sprouts, which lies on its parent segment's axis; Parents come
+    # before their children in the store.
+    stem_amplitudes = np.zeros((len(store), max_sway_levels), dtype=np.float32)
+    stem_phases = np.zeros((len(store), max_sway_levels), dtype=np.float32)
+    for idx in np.nonzero(stem_root & (store.parent >= 0))[0].tolist():
+        parent = store.parent[idx]
+        parent_stem = store.stem[parent]
+        stem_amplitudes[idx] = stem_amplitudes[parent_stem]
+        stem_phases[idx] = stem_phases[parent_stem]
+        if has_slot[parent]:
+            direction = store.transform[parent, 2, :3]
+            back = np.dot(store.transform[parent, 3, :3] - feet[idx], direction)
+            along = np.clip(1.0 - back / max(store.length[parent], 1e-6), 0.0, 1.0)
+            amplitude = bottom_amplitude[parent] + (top_amplitude[parent] - bottom_amplitude[parent]) * along
+            stem_amplitudes[idx, slot[parent]] = amplitude
+            stem_phases[idx, slot[parent]] = phase[parent]
+
+    segment_of_ring, is_foot = store_ring_segments(store)
+    amplitudes = stem_amplitudes[store.stem[segment_of_ring]]
+    phases = stem_phases[store.stem[segment_of_ring]]
+    own = np.nonzero(has_slot[segment_of_ring])[0]
+    own_slot = slot[segment_of_ring[own]]
+    amplitudes[own, own_slot] = np.where(is_foot[own], 0.0, top_amplitude[segment_of_ring[own]])
+    phases[own, own_slot] = phase[segment_of_ring[own]]
+    return feet[store.stem][segment_of_ring], amplitudes, phases
+
+
+def wind_vertices(vertices, wind_data, circle_segments=10):
+    pivots, amplitudes, phases = wind_data
+    wind = np.empty(len(vertices), dtype=wind_vertex_dtype)
+    for field in vertex_dtype.names:
+        wind[field] = vertices[field]
+    wind['pivot'] = np.repeat(pivots, circle_segments, axis=0)
+    wind['sway_amplitude'] = np.repeat(amplitudes, circle_segments, axis=0)
+    wind['sway_phase'] = np.repeat(phases, circle_segments, axis=0)
+    return wind
+
+
+wind_vertex_shader = """
+#version 140
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform float osg_FrameTime;
+uniform vec2 wind_direction;
+uniform float wind_strength;
+uniform float tree_height;
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec4 p3d_Color;
+in vec4 sway_amplitude;  // Per stem level 1 to 4
+in vec4 sway_phase;
+
+out vec3 normal;
+out vec4 color;
+
+void main() {
+    vec3 direction = vec3(wind_direction, 0.0);
+    vec4 vertex = p3d_Vertex;
+
+    // The whole tree bends with height.
+    float height = max(vertex.z, 0.0) / max(tree_height, 0.001);
+    float gust = 0.7 + 0.3 * sin(osg_FrameTime * 0.9);
+    vertex.xyz += direction * wind_strength * gust * height * height;
+
+    // Each stem the vertex is on or grows from sways, thin ones more,
+    // and faster.
+    for (int slot = 0; slot < 4; slot++) {
+        float level = float(slot + 1);
+        float frequency = 1.5 + level * 1.3;
+        float swing = sin(osg_FrameTime * frequency + sway_phase[slot]);
+        float bend = wind_strength * 0.1 * sway_amplitude[slot] * swing;
+        vertex.xyz += (direction + vec3(0.0, 0.0, 0.3 * level)) * bend;
+    }
+
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+    normal = p3d_Normal;
+    color = p3d_Color;
+}
+"""
+
+
+wind_fragment_shader = """
+#version 140
+
+in vec3 normal;
+in vec4 color;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    p3d_FragColor = color;
+}
+"""
+
+
+def wind_shader():
+    return Shader.make(Shader.SL_GLSL, vertex=wind_vertex_shader, fragment=wind_fragment_shader)
+
+
+def apply_wind(tree_np, tree_height, direction=(1.0, 0.0), strength=0.5):
+    # Sets up the NodePath of a tree meshed with `wind=True` to sway.
+    tree_np.set_shader(wind_shader())
+    tree_np.set_shader_input('wind_direction', direction)
+    tree_np.set_shader_input('wind_strength', strength)
+    tree_np.set_shader_input('tree_height', tree_height)
+
+
+# Bark
+#
+# For texturing, rings get a seam: An extra vertex at the end, in the
+# same place as the first one, so that U can run from 0 to 1 around the
+# ring. V runs up along each stem, in units of the circumference of the
+# stem's foot, so the texture is continuous from segment to segment, and
+# square at the stem's foot. Tangents point around the ring in the
+# direction of U, and binormals up the stem in the direction of V.
+#
+# `bark_vertex_dtype` has all of that as floats, in the columns that
+# Panda3D's shader generator uses for normal mapping. The compact format
+# packs normals and tangents into signed bytes, and leaves out binormals
+# (which are `cross(normal, tangent) * sign(tangent.w)`), so it takes
+# the same 28 bytes per vertex as `vertex_dtype`, half as much as the
+# float format. Panda3D 1.10 has no half float vertex columns, so the
+# UVs stay 32 bit floats. The compact format needs `bark_shader`.
+
+bark_vertex_dtype = np.dtype(
+    [
+        ('vertex', '<f4', 3),
+        ('normal', '<f4', 3),
+        ('texcoord', '<f4', 2),
+        ('tangent', '<f4', 3),
+        ('binormal', '<f4', 3),
+    ],
+)
+
+
+compact_vertex_dtype = np.dtype(
+    [
+        ('vertex', '<f4', 3),
+        ('normal', 'i1', 4),
+        ('tangent', 'i1', 4),   # w is the handedness of the frame
+        ('texcoord', '<f4', 2),
+    ],
+)
+
+
+_bark_vertex_format = None
+_compact_vertex_format = None
+
+
+def bark_vertex_format():
+    global _bark_vertex_format
+    if _bark_vertex_format is None:
+        array_format = GeomVertexArrayFormat()
+        array_format.add_column(InternalName.get_vertex(), 3, Geom.NT_float32, Geom.C_point)
+        array_format.add_column(InternalName.get_normal(), 3, Geom.NT_float32, Geom.C_normal)
+        array_format.add_column(InternalName.get_texcoord(), 2, Geom.NT_float32, Geom.C_texcoord)
+        array_format.add_column(InternalName.get_tangent(), 3, Geom.NT_float32, Geom.C_vector)
+        array_format.add_column(InternalName.get_binormal(), 3, Geom.NT_float32, Geom.C_vector)
+        _bark_vertex_format = GeomVertexFormat.register_format(array_format)
+    return _bark_vertex_format
+
+
+def compact_vertex_format():
+    global _compact_vertex_format
+    if _compact_vertex_format is None:
+        array_format = GeomVertexArrayFormat()
+        array_format.add_column(InternalName.get_vertex(), 3, Geom.NT_float32, Geom.C_point)
+        array_format.add_column(InternalName.get_normal(), 4, Geom.NT_int8, Geom.C_normal)
+        array_format.add_column(InternalName.get_tangent(), 4, Geom.NT_int8, Geom.C_vector)
+        array_format.add_column(InternalName.get_texcoord(), 2, Geom.NT_float32, Geom.C_texcoord)
+        _compact_vertex_format = GeomVertexFormat.register_format(array_format)
+    return _compact_vertex_format
+
+
+def store_bark_v(store):
+    # Per ring, in the order of `store_rings`: The V coordinate.
+    circumference = 2.0 * np.pi * np.maximum(store.radius[store.stem], 1e-6)
+    v = stem_distances(store) / circumference
+    segment_of_ring, is_foot = store_ring_segments(store)
+    return np.where(is_foot, 0.0, v[segment_of_ring]).astype(np.float32)
+
+
+def pack_snorm8(vectors):
+    return np.clip(np.round(vectors * 127.0), -127, 127).astype(np.int8)
+
+
+def bark_vertices(rings, v, circle_segments=10, compact=False):
+    # Vertices for rings with seams, as `bark_indices(..., seam=True)`
+    # connects them.
+    num_rings = len(rings.radii)
+    sin_h, cos_h = _ring_headings(rings, circle_segments, seam=True)
+    points, normals = _ring_points(rings, sin_h, cos_h)
+    local_tangents = np.zeros((num_rings, circle_segments + 1, 4), dtype=np.float32)
+    local_tangents[:, :, 0] = -cos_h
+    local_tangents[:, :, 1] = -sin_h
+    tangents = np.matmul(local_tangents, rings.mats)[:, :, :3]
+    u = np.arange(circle_segments + 1, dtype=np.float32) / circle_segments
+
+    if compact:
+        vertices = np.empty((num_rings, circle_segments + 1), dtype=compact_vertex_dtype)
+        vertices['normal'][:, :, :3] = pack_snorm8(normals)
+        vertices['normal'][:, :, 3] = 0
+        vertices['tangent'][:, :, :3] = pack_snorm8(tangents)
+        vertices['tangent'][:, :, 3] = 127
+    else:
+        vertices = np.empty((num_rings, circle_segments + 1), dtype=bark_vertex_dtype)
+        vertices['normal'] = normals
+        vertices['tangent'] = tangents
+        vertices['binormal'] = rings.mats[:, np.newaxis, 2, :3]
+    vertices['vertex'] = points
+    vertices['texcoord'][:, :, 0] = u[np.newaxis, :]
+    vertices['texcoord'][:, :, 1] = v[:, np.newaxis]
+    return vertices.reshape(-1)
+
+
+bark_vertex_shader = """
+#version 140
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec4 p3d_Tangent;
+in vec2 p3d_MultiTexCoord0;
+
+out vec3 normal;
+out vec3 tangent;
+out float handedness;
+out vec2 uv;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    // Packed normals and tangents may or may not arrive normalized.
+    normal = normalize(p3d_Normal);
+    tangent = normalize(p3d_Tangent.xyz);
+    handedness = p3d_Tangent.w < 0.0 ? -1.0 : 1.0;
+    uv = p3d_MultiTexCoord0;
+}
+"""
+
+
+bark_fragment_shader = """
+#version 140
+
+uniform sampler2D p3d_Texture0;  // Bark color
+uniform sampler2D p3d_Texture1;  // Bark normal map
+uniform vec3 light_direction;    // Towards the light, in model space
+
+in vec3 normal;
+in vec3 tangent;
+in float handedness;
+in vec2 uv;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    vec3 n = normalize(normal);
+    vec3 t = normalize(tangent - n * dot(n, tangent));
+    vec3 b = cross(n, t) * handedness;
+    vec3 mapped = texture(p3d_Texture1, uv).xyz * 2.0 - 1.0;
+    vec3 shading_normal = normalize(mat3(t, b, n) * mapped);
+    float light = 0.3 + 0.7 * max(dot(shading_normal, normalize(light_direction)), 0.0);
+    p3d_FragColor = vec4(texture(p3d_Texture0, uv).rgb * light, 1.0);
+}
+"""
+
+
+def bark_shader():
+    return Shader.make(Shader.SL_GLSL, vertex=bark_vertex_shader, fragment=bark_fragment_shader)
+
+
+def apply_bark(tree_np, color_texture, normal_map, light_direction=(0.3, -0.5, 0.8)):
+    # Sets up the NodePath of a tree meshed with `VertexFormat.BARK` or
+    # `VertexFormat.COMPACT` to show textured bark.
+    tree_np.set_shader(bark_shader())
+    color_stage = TextureStage('bark_color')
+    color_stage.set_sort(0)
+    normal_stage = TextureStage('bark_normal')
+    normal_stage.set_sort(1)
+    tree_np.set_texture(color_stage, color_texture)
+    tree_np.set_texture(normal_stage, normal_map)
+    tree_np.set_shader_input('light_direction', Vec3(*light_direction))
+
+
+# Streaming mesh building
+#
+# For very large trees, the mesh can be built while the tree is being
+# expanded, in chunks of a bounded number of vertices, so that neither
+# the whole tree nor the whole mesh need to be in memory at once, and
+# the first chunks can be shown before the tree is finished.
+
+
+def stream_trimesh(segments, circle_segments=10, bark_tris=True, max_vertices=65536):
+    # Consumes expanded segments, parents first (e.g. from
+    # `homebrew.expand_iter`), and yields GeomNodes with at most
+    # `max_vertices` vertices each.
+    max_rings = max(2, max_vertices // circle_segments)
+    collector = RingCollector(chunk=0)
+    root_node = None
+    for s in segments:
+        if root_node is None:
+            root_node = s[sg.TREE_ROOT][sg.TREE_ROOT_NODE]
+        if len(collector) + 2 > max_rings:  # A segment adds up to two rings.
+            yield _chunk_geom_node(collector, circle_segments, bark_tris)
+            collector = RingCollector(chunk=collector.chunk + 1)
+        collector.add_segment(s, root_node)
+    if len(collector) > 0:
+        yield _chunk_geom_node(collector, circle_segments, bark_tris)
+
+
+def _chunk_geom_node(collector, circle_segments, bark_tris):
+    rings = collector.rings()
+    vertices = ring_vertices(rings, circle_segments)
+    indices = bark_indices(rings, circle_segments, bark_tris)
+    name = 'geom_node_chunk_{}'.format(collector.chunk)
+    return make_geom_node(vertices, indices, bark_tris, name=name)
+
+
+def stream_tree(tree, tropisms=True, circle_segments=10, bark_tris=True, max_vertices=65536):
+    # Expands `tree` and yields its mesh in chunks as it grows. Segments
+    # are released once they are meshed, so only the segments on the
+    # path to the current one stay in memory.
+    segments = expand_iter(tree, tropisms=tropisms, scene_graph=False, release_segments=True)
+    yield from stream_trimesh(segments, circle_segments, bark_tris, max_vertices)
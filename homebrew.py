@@ -1,65 +1,163 @@
-import random
 import math
+import time
+import heapq
+import logging
+import itertools
+from collections import defaultdict
+from collections import namedtuple
+
+import numpy as np
 
 from panda3d.core import Vec3
 from panda3d.core import NodePath
 
 from tree_specs import StemDefinition as sd
 from tree_specs import Segment as sg
+from frames import Frame
+from counter_rng import CounterRNG
+from counter_rng import seed_key
 
 
 up = Vec3(0, 0, 1)
+logger = logging.getLogger(__name__)
+
 
+# Tracing stages; These are only added to the stages if debug logging
+# is enabled for this module, so they cost nothing otherwise.
 
-def print_definition_name(s):
+def trace_definition_name(s):
     if sg.DEFINITION in s and sd.NAME in s[sg.DEFINITION]:
-        print(s[sg.DEFINITION][sd.NAME])
+        logger.debug("Expanding %s", s[sg.DEFINITION][sd.NAME])
+
+
+def trace_tropisms(s):
+    if sg.DEFINITION in s and sd.NAME in s[sg.DEFINITION]:
+        logger.debug(
+            "%s: design tropism %s, heliotropism %s",
+            s[sg.DEFINITION][sd.NAME],
+            s[sg.DESIGN_TROPISM],
+            s[sg.HELIOTROPISM],
+        )
+
+
+def batched_values(func, age, ratios):
+    # Blending functions that don't draw random numbers give the same
+    # value for the same age and ratio, so they are evaluated for all
+    # segments of a definition in one batch, once per tree. Returns None
+    # for functions that have to be called per segment, to use its RNG,
+    # or because they are made of plain callables that can't be batched.
+    if func is None or not hasattr(func, 'batchable') or not func.batchable():
+        return None
+    return func.batch(age, np.array(ratios), None).tolist()
+
+
+class StemPlan:
+    # What the stages need to know about a StemDefinition, looked up and
+    # computed once per tree instead of once per segment. Tables are
+    # indexed by `segments - rest_segments`; Functions of optional keys
+    # are None if the definition doesn't have them.
+    __slots__ = (
+        'definition', 'segments', 'ratios', 'mid_ratios',
+        'length_func', 'radius_func', 'bending_func',
+        'split_chance_func', 'split_angle_func',
+        'branch_density_func', 'branch_angle_func', 'branch_rotation_func',
+        'design_tropism_func', 'heliotropism_func',
+        'child_definition',
+        'radius_values', 'bending_values', 'design_tropism_values', 'heliotropism_values',
+    )
+
+    def __init__(self, definition, age):
+        self.definition = definition
+        self.segments = segments = definition[sd.SEGMENTS]
+        self.ratios = [idx / segments for idx in range(segments + 1)]
+        # Branch density is measured at mid-segment.
+        self.mid_ratios = [(idx - 0.5) / segments for idx in range(segments + 1)]
+
+        self.length_func = definition[sd.LENGTH]
+        self.radius_func = definition[sd.RADIUS]
+        self.bending_func = definition[sd.BENDING]
+        self.split_chance_func = definition.get(sd.SPLIT_CHANCE)
+        self.split_angle_func = definition.get(sd.SPLIT_ANGLE)
+        self.branch_density_func = definition.get(sd.BRANCH_DENSITY)
+        self.branch_angle_func = definition.get(sd.BRANCH_ANGLE)
+        self.branch_rotation_func = definition.get(sd.BRANCH_ROTATION)
+        self.design_tropism_func = definition.get(sd.DESIGN_TROPISM)
+        self.heliotropism_func = definition.get(sd.HELIOTROPISM)
+        self.child_definition = definition.get(sd.CHILD_DEFINITION)
+
+        self.radius_values = batched_values(self.radius_func, age, self.ratios)
+        self.bending_values = batched_values(self.bending_func, age, self.ratios)
+        self.design_tropism_values = batched_values(self.design_tropism_func, age, self.ratios)
+        self.heliotropism_values = batched_values(self.heliotropism_func, age, self.ratios)
+
+
+def stem_plan(s):
+    # The plan for the stem that `s` starts, from the tree's cache.
+    tree_root = s[sg.TREE_ROOT]
+    definition = s[sg.DEFINITION]
+    plans = tree_root.setdefault(sg.STEM_PLANS, {})
+    if id(definition) not in plans:
+        plans[id(definition)] = StemPlan(definition, tree_root[sg.AGE])
+    return plans[id(definition)]
 
 
 def set_up_rng(s):
+    # The tree's root gets its seed from the user; Other segments get a
+    # key derived from their parent's key and their place among its
+    # children (see `continuations`).
     if sg.RNG_SEED not in s:
         s[sg.RNG_SEED] = 0
-    s[sg.RNG] = random.Random(s[sg.RNG_SEED])
+    if sg.PARENT_SEGMENT in s:
+        s[sg.RNG] = CounterRNG(s[sg.RNG_SEED])
+    else:
+        s[sg.RNG] = CounterRNG(seed_key(s[sg.RNG_SEED]))
 
 
-def hierarchy(s):
-    # On the tree's root, we need a NodePath that'll attach to the scene.
+def frame_hierarchy(s):
+    hierarchy(s, node_type=Frame)
+
+
+def hierarchy(s, node_type=NodePath):
+    # On the tree's root, we need a NodePath that'll attach to the scene
+    # (or a Frame, if we don't want to create scene graph nodes).
     if sg.TREE_ROOT not in s:
         s[sg.TREE_ROOT] = s
-        s[sg.TREE_ROOT_NODE] = NodePath('tree_root')
+        s[sg.TREE_ROOT_NODE] = node_type('tree_root')
 
     # If this is a new stem, set the administrative numbers.
     if sg.STEM_ROOT not in s:
         s[sg.STEM_ROOT] = s
-        s[sg.REST_SEGMENTS] = s[sg.DEFINITION][sd.SEGMENTS] - 1
+        s[sg.STEM_PLAN] = stem_plan(s)
+        s[sg.REST_SEGMENTS] = s[sg.STEM_PLAN].segments - 1
         s[sg.SPLIT_ACCUMULATOR] = 0.0
+    else:
+        s[sg.STEM_PLAN] = s[sg.STEM_ROOT][sg.STEM_PLAN]
 
     s[sg.CONTINUATIONS] = []
     s[sg.BRANCHES] = []
 
 
 def continuations(s):
-    definition = s[sg.STEM_ROOT][sg.DEFINITION]
-    segments = definition[sd.SEGMENTS]
+    plan = s[sg.STEM_PLAN]
+    segments = plan.segments
     rest_segments = s[sg.REST_SEGMENTS]
     rng = s[sg.RNG]
 
     if rest_segments > 0: # Not the last segment?
         # How many splits do we have?
-        if sd.SPLIT_CHANCE not in definition:
+        if plan.split_chance_func is None:
             splits = 0
         else:
-            ratio = (segments - rest_segments) / segments
+            ratio = plan.ratios[segments - rest_segments]
             accumulator = s[sg.STEM_ROOT][sg.SPLIT_ACCUMULATOR]
-            split_chance_func = definition[sd.SPLIT_CHANCE]
-            splits, accumulator = split_chance_func(ratio, accumulator, rng)
+            splits, accumulator = plan.split_chance_func(ratio, accumulator, rng)
             s[sg.STEM_ROOT][sg.SPLIT_ACCUMULATOR] = accumulator
 
         if splits == 0:
             # Regular continuation
             s[sg.CONTINUATIONS].append(
                 {
-                    sg.RNG_SEED: s[sg.RNG].randint(0, 2<<16 - 1),
+                    sg.RNG_SEED: rng.spawn_key(len(s[sg.CONTINUATIONS])),
                     sg.TREE_ROOT: s[sg.TREE_ROOT],
                     sg.STEM_ROOT: s[sg.STEM_ROOT],
                     sg.PARENT_SEGMENT: s,
@@ -70,7 +168,7 @@ def continuations(s):
             for idx in range(splits + 1):
                 s[sg.CONTINUATIONS].append(
                     {
-                        sg.RNG_SEED: s[sg.RNG].randint(0, 2<<16 - 1),
+                        sg.RNG_SEED: rng.spawn_key(len(s[sg.CONTINUATIONS])),
                         sg.TREE_ROOT: s[sg.TREE_ROOT],
                         sg.STEM_ROOT: s[sg.STEM_ROOT],
                         sg.PARENT_SEGMENT: s,
@@ -80,19 +178,18 @@ def continuations(s):
                 )
 
     # Branch splits
-    if sd.CHILD_DEFINITION in definition:
+    if plan.child_definition is not None:
         age = s[sg.TREE_ROOT][sg.AGE]
-        ratio = (segments - rest_segments - 0.5) / segments  # We measure density at mid-segment.
-        branch_density_func = definition[sd.BRANCH_DENSITY]
-        branch_density = branch_density_func(age, ratio, rng)
+        ratio = plan.mid_ratios[segments - rest_segments]
+        branch_density = plan.branch_density_func(age, ratio, rng)
         for idx in range(math.floor(branch_density)):
             s[sg.CONTINUATIONS].append(
                 {
-                    sg.RNG_SEED: s[sg.RNG].randint(0, 2<<16 - 1),
+                    sg.RNG_SEED: rng.spawn_key(len(s[sg.CONTINUATIONS])),
                     sg.TREE_ROOT: s[sg.TREE_ROOT],
                     sg.PARENT_SEGMENT: s,
                     sg.IS_NEW_BRANCH: (idx + 1) / branch_density,
-                    sg.DEFINITION: s[sg.STEM_ROOT][sg.DEFINITION][sd.CHILD_DEFINITION],
+                    sg.DEFINITION: plan.child_definition,
                 },
             )
 
@@ -101,7 +198,7 @@ def length(s):
     if sg.TREE_ROOT_NODE in s:
         # On the tree's root, the tree's overall length is determined on the tree root.
         age = s[sg.TREE_ROOT][sg.AGE]
-        length_func = s[sg.STEM_ROOT][sg.DEFINITION][sd.LENGTH]
+        length_func = s[sg.STEM_PLAN].length_func
         rng = s[sg.RNG]
 
         length = length_func(age, 0, rng)
@@ -110,9 +207,9 @@ def length(s):
     elif sg.IS_NEW_BRANCH in s:
         # A branch's length is determined in relation to its parent.
         age = s[sg.TREE_ROOT][sg.AGE]
-        length_func = s[sg.STEM_ROOT][sg.DEFINITION][sd.LENGTH]
+        length_func = s[sg.STEM_PLAN].length_func
         rng = s[sg.RNG]
-        parent_segments = s[sg.PARENT_SEGMENT][sg.STEM_ROOT][sg.DEFINITION][sd.SEGMENTS]
+        parent_segments = s[sg.PARENT_SEGMENT][sg.STEM_PLAN].segments
         parent_offset = parent_segments - s[sg.PARENT_SEGMENT][sg.REST_SEGMENTS] + s[sg.IS_NEW_BRANCH] - 1
         parent_ratio = parent_offset / parent_segments
 
@@ -121,7 +218,7 @@ def length(s):
         s[sg.BRANCH_RATIO] = parent_ratio
 
     # What is this stem's length per segment?
-    segments = s[sg.STEM_ROOT][sg.DEFINITION][sd.SEGMENTS]
+    segments = s[sg.STEM_PLAN].segments
     stem_length = s[sg.STEM_ROOT][sg.STEM_LENGTH]
     segment_legth = stem_length / segments
 
@@ -129,17 +226,24 @@ def length(s):
 
 
 def radius(s):
-    age = s[sg.TREE_ROOT][sg.AGE]
-    segments = s[sg.STEM_ROOT][sg.DEFINITION][sd.SEGMENTS]
+    plan = s[sg.STEM_PLAN]
+    segments = plan.segments
     rest_segments = s[sg.REST_SEGMENTS]
-    ratio = (segments - rest_segments) / segments
-    radius_func = s[sg.STEM_ROOT][sg.DEFINITION][sd.RADIUS]
-    rng = s[sg.RNG]
+    values = plan.radius_values
 
+    if values is not None:
+        if sg.TREE_ROOT_NODE in s:  # Trunk of the tree
+            s[sg.ROOT_RADIUS] = values[0]
+        s[sg.RADIUS] = values[segments - rest_segments]
+        return
+
+    age = s[sg.TREE_ROOT][sg.AGE]
+    ratio = plan.ratios[segments - rest_segments]
+    rng = s[sg.RNG]
     if sg.TREE_ROOT_NODE in s:  # Trunk of the tree
-        s[sg.ROOT_RADIUS] = radius_func(age, 0, rng)
+        s[sg.ROOT_RADIUS] = plan.radius_func(age, 0, rng)
 
-    s[sg.RADIUS] = radius_func(age, ratio, rng)
+    s[sg.RADIUS] = plan.radius_func(age, ratio, rng)
 
 
 def attach_node(s):
@@ -157,14 +261,12 @@ def attach_node(s):
 
 def split_curvature(s):
     if sg.IS_NEW_SPLIT in s:
-        definition = s[sg.STEM_ROOT][sg.DEFINITION]
+        plan = s[sg.STEM_PLAN]
         split_idx, num_splits = s[sg.IS_NEW_SPLIT]
         age = s[sg.TREE_ROOT][sg.AGE]
-        segments = definition[sd.SEGMENTS]
-        rest_segments = s[sg.REST_SEGMENTS]
-        ratio = (segments - rest_segments) / segments
+        ratio = plan.ratios[plan.segments - s[sg.REST_SEGMENTS]]
         rng = s[sg.RNG]
-        split_angle_func = definition[sd.SPLIT_ANGLE]
+        split_angle_func = plan.split_angle_func
         node = s[sg.NODE]
 
         hpr = split_angle_func(age, ratio, split_idx, num_splits, rng)
@@ -177,11 +279,12 @@ def branch_curvature(s):
         age = s[sg.TREE_ROOT][sg.AGE]
         rng = s[sg.RNG]
         branch_ratio = s[sg.BRANCH_RATIO]
-        branch_rotation_func = s[sg.DEFINITION][sd.BRANCH_ROTATION]
-        branch_angle_func = s[sg.DEFINITION][sd.BRANCH_ANGLE]
+        plan = s[sg.STEM_PLAN]
+        branch_rotation_func = plan.branch_rotation_func
+        branch_angle_func = plan.branch_angle_func
         node = s[sg.NODE]
         parent_node = s[sg.PARENT_SEGMENT][sg.NODE]
-        length = s[sg.LENGTH] / s[sg.DEFINITION][sd.SEGMENTS]
+        length = s[sg.LENGTH] / plan.segments
 
         node.set_h(node.get_h() + branch_rotation_func(age, branch_ratio, rng))
         node.set_p(node.get_p() + branch_angle_func(age, branch_ratio, rng))
@@ -195,14 +298,17 @@ def branch_curvature(s):
 
 def bending(s):
     node = s[sg.NODE]
-    age = s[sg.TREE_ROOT][sg.AGE]
-    segments = s[sg.STEM_ROOT][sg.DEFINITION][sd.SEGMENTS]
+    plan = s[sg.STEM_PLAN]
+    segments = plan.segments
     rest_segments = s[sg.REST_SEGMENTS]
-    bending_func = s[sg.STEM_ROOT][sg.DEFINITION][sd.BENDING]
-    ratio = (segments - rest_segments) / segments
-    rng = s[sg.RNG]
+    values = plan.bending_values
 
-    heading, pitch, roll = bending_func(age, ratio, rng)
+    if values is not None:
+        heading, pitch, roll = values[segments - rest_segments]
+    else:
+        age = s[sg.TREE_ROOT][sg.AGE]
+        ratio = plan.ratios[segments - rest_segments]
+        heading, pitch, roll = plan.bending_func(age, ratio, s[sg.RNG])
 
     node.set_hpr(
         node.get_h() + heading / segments,
@@ -217,44 +323,44 @@ def design_tropism(s):
         parent_node = s[sg.TREE_ROOT_NODE]
     else:
         parent_node = s[sg.PARENT_SEGMENT][sg.NODE]
-    design_tropic_weight_func = s[sg.STEM_ROOT][sg.DEFINITION][sd.DESIGN_TROPISM]
-    age = s[sg.TREE_ROOT][sg.AGE]
-    segments = s[sg.STEM_ROOT][sg.DEFINITION][sd.SEGMENTS]
+    plan = s[sg.STEM_PLAN]
+    segments = plan.segments
     rest_segments = s[sg.REST_SEGMENTS]
-    ratio = (segments - rest_segments) / segments
-    rng = s[sg.RNG]
+    values = plan.design_tropism_values
 
-    design_tropic_weight = design_tropic_weight_func(age, ratio, rng)
+    if values is not None:
+        design_tropic_weight = values[segments - rest_segments]
+    else:
+        age = s[sg.TREE_ROOT][sg.AGE]
+        ratio = plan.ratios[segments - rest_segments]
+        design_tropic_weight = plan.design_tropism_func(age, ratio, s[sg.RNG])
 
     s[sg.DESIGN_TWIST] = node.get_h()
     s[sg.DESIGN_TROPISM] = parent_node.get_relative_vector(node, up) * design_tropic_weight
 
-    if sg.DEFINITION in s and sd.NAME in s[sg.DEFINITION]:
-        print(s[sg.DESIGN_TROPISM])
-
 
 def heliotropism(s):
     if sg.TREE_ROOT_NODE in s:
         parent_node = s[sg.TREE_ROOT_NODE]
     else:
         parent_node = s[sg.PARENT_SEGMENT][sg.NODE]
-    tree_root_node = s[sg.TREE_ROOT][sg.TREE_ROOT_NODE]
-    age = s[sg.TREE_ROOT][sg.AGE]
-    segments = s[sg.STEM_ROOT][sg.DEFINITION][sd.SEGMENTS]
+    tree_root = s[sg.TREE_ROOT]
+    tree_root_node = tree_root[sg.TREE_ROOT_NODE]
+    global_heliotropic_direction = tree_root[sg.HELIOTROPIC_DIRECTION]
+    plan = s[sg.STEM_PLAN]
+    segments = plan.segments
     rest_segments = s[sg.REST_SEGMENTS]
-    ratio = (segments - rest_segments) / segments
-    rng = s[sg.RNG]
-    heliotropic_weight_func = s[sg.STEM_ROOT][sg.DEFINITION][sd.HELIOTROPISM]
-    global_heliotropic_direction = s[sg.TREE_ROOT][sg.HELIOTROPIC_DIRECTION]
+    values = plan.heliotropism_values
 
     local_heliotropic_direction = parent_node.get_relative_vector(tree_root_node, global_heliotropic_direction)
-    heliotropic_weight = heliotropic_weight_func(age, ratio, rng)
+    if values is not None:
+        heliotropic_weight = values[segments - rest_segments]
+    else:
+        ratio = plan.ratios[segments - rest_segments]
+        heliotropic_weight = plan.heliotropism_func(tree_root[sg.AGE], ratio, s[sg.RNG])
 
     s[sg.HELIOTROPISM] = local_heliotropic_direction * heliotropic_weight
 
-    if sg.DEFINITION in s and sd.NAME in s[sg.DEFINITION]:
-        print(s[sg.HELIOTROPISM])
-
 
 def apply_tropisms(s):
     if sg.TREE_ROOT_NODE in s:
@@ -294,34 +400,289 @@ def apply_tropisms(s):
     node.set_z(node, length)
 
 
-def expand(s, tropisms=True):
+def grow_straight(s):
+    # Without tropisms, the segment just extends in its own direction.
+    s[sg.NODE].set_z(s[sg.NODE], s[sg.LENGTH])
+
+
+def default_stages(tropisms=True, scene_graph=True, trace=None):
+    # The stages that `expand` runs on each segment, in order. Each is
+    # a function taking the segment. Any list of such functions can be
+    # passed to `expand` and `expand_fully` instead.
+    if trace is None:
+        trace = logger.isEnabledFor(logging.DEBUG)
+
+    stages = []
     # Debug
-    print_definition_name(s)
+    if trace:
+        stages.append(trace_definition_name)
     # Segment logistics
-    set_up_rng(s)
-    hierarchy(s)
-    continuations(s)
+    stages += [
+        set_up_rng,
+        hierarchy if scene_graph else frame_hierarchy,
+        continuations,
+    ]
     # Segment visualization
-    length(s)
-    radius(s)
+    stages += [length, radius]
     # Design
-    attach_node(s)
-    split_curvature(s)
-    branch_curvature(s)
-    bending(s)
+    stages += [attach_node, split_curvature, branch_curvature, bending]
     # Tropisms
     if tropisms:
-        design_tropism(s)
-        heliotropism(s)
-        apply_tropisms(s)
+        stages += [design_tropism, heliotropism]
+        if trace:
+            stages.append(trace_tropisms)
+        stages.append(apply_tropisms)
+    else:
+        stages.append(grow_straight)
+    return stages
+
+
+class ExpansionProfile:
+    # Pass one as `collector` to `expand` or `expand_fully` to record,
+    # per stage and per StemDefinition level (0 being the trunk), the
+    # cumulative time spent and number of calls, and the number of
+    # segments expanded per level.
+    def __init__(self):
+        self.seconds = defaultdict(float)  # (stage name, level) -> seconds
+        self.calls = defaultdict(int)      # (stage name, level) -> calls
+        self.segments = defaultdict(int)   # level -> segments
+        self._levels = {}
+
+    def level(self, s):
+        if sg.DEFINITION in s:
+            definition = s[sg.DEFINITION]
+        else:
+            definition = s[sg.STEM_ROOT][sg.DEFINITION]
+        if id(definition) not in self._levels:
+            level = 0
+            level_definition = s.get(sg.TREE_ROOT, s)[sg.DEFINITION]
+            while level_definition is not definition:
+                level_definition = level_definition[sd.CHILD_DEFINITION]
+                level += 1
+            self._levels[id(definition)] = level
+        return self._levels[id(definition)]
+
+    def expand(self, s, stages):
+        level = self.level(s)
+        self.segments[level] += 1
+        for stage in stages:
+            start = time.perf_counter()
+            stage(s)
+            key = (stage.__name__, level)
+            self.seconds[key] += time.perf_counter() - start
+            self.calls[key] += 1
+
+    def stage_seconds(self):
+        # Total time per stage over all levels.
+        totals = defaultdict(float)
+        for (stage, _), seconds in self.seconds.items():
+            totals[stage] += seconds
+        return dict(totals)
+
+    def report(self):
+        lines = []
+        for (stage, level), seconds in sorted(self.seconds.items(), key=lambda item: -item[1]):
+            calls = self.calls[stage, level]
+            lines.append(
+                '{:20} level {} {:8d} calls {:10.6f}s {:8.2f}us/call'.format(
+                    stage, level, calls, seconds, seconds / calls * 1e6,
+                ),
+            )
+        return '\n'.join(lines)
+
+
+def expand(s, tropisms=True, scene_graph=True, stages=None, collector=None):
+    if stages is None:
+        stages = default_stages(tropisms=tropisms, scene_graph=scene_graph)
+    if collector is None:
+        for stage in stages:
+            stage(s)
     else:
-        s[sg.NODE].set_z(s[sg.NODE], s[sg.LENGTH])
+        collector.expand(s, stages)
 
 
-def expand_fully(s, tropisms=True):
+def release(s):
+    # Once a segment's children have been created, it only needs to
+    # keep what they still read from it. Dropping the references to the
+    # children lets finished subtrees be garbage collected.
+    del s[sg.RNG]
+    s[sg.CONTINUATIONS] = []
+    s[sg.BRANCHES] = []
+
+
+def expand_iter(s, tropisms=True, scene_graph=True, stages=None, collector=None, release_segments=False):
+    # Expands the tree segment by segment, yielding each one once it
+    # and its children have been created. With `release_segments`,
+    # segments are released after the consumer is done with them.
+    if stages is None:
+        stages = default_stages(tropisms=tropisms, scene_graph=scene_graph)
+    segments = [s]
+    while segments:
+        segment = segments.pop()
+        expand(segment, stages=stages, collector=collector)
+        segments += segment[sg.CONTINUATIONS]
+        segments += segment[sg.BRANCHES]
+        yield segment
+        if release_segments:
+            release(segment)
+
+
+def expand_fully(s, tropisms=True, scene_graph=True, store=None, stages=None, collector=None):
+    # With `scene_graph=False`, segments get a `Frame` instead of a
+    # NodePath, so the expansion creates no scene graph nodes, and can
+    # run where there is no scene graph to speak of, e.g. in worker
+    # processes; It takes about as long as with NodePaths. Use
+    # `materialize_nodes` to turn them into NodePaths later if needed.
+    # If a `SegmentStore` is given, the segments are recorded into it,
+    # and the segment dicts are released as the expansion goes on.
+    segments = expand_iter(
+        s,
+        tropisms=tropisms,
+        scene_graph=scene_graph,
+        stages=stages,
+        collector=collector,
+        release_segments=store is not None,
+    )
+    for segment in segments:
+        if store is not None:
+            store.add(segment)
+
+
+# complete: Whether the tree was grown fully within the budget.
+# levels: Number of stem levels in the tree; With `keep_partial_level`,
+#     the last one may have only its most important stems.
+# segments, vertices: Segments in the tree as returned, and the bark
+#     vertices they need.
+# expanded_segments, expanded_vertices: The same, but for all segments
+#     that were expanded, including those pruned again.
+BudgetResult = namedtuple(
+    'BudgetResult',
+    'complete levels segments vertices expanded_segments expanded_vertices',
+)
+
+
+def prune_stem(stem):
+    # Removes a stem from its parent's children, and its nodes from the
+    # scene graph.
+    parent = stem[sg.PARENT_SEGMENT]
+    parent[sg.CONTINUATIONS] = [c for c in parent[sg.CONTINUATIONS] if c is not stem]
+    parent[sg.BRANCHES] = [c for c in parent[sg.BRANCHES] if c is not stem]
+    if isinstance(stem.get(sg.NODE), NodePath):
+        stem[sg.NODE].remove_node()
+
+
+def expand_budgeted(
+        s,
+        max_segments=None,
+        max_vertices=None,
+        max_seconds=None,
+        circle_segments=10,
+        keep_partial_level=False,
+        tropisms=True,
+        scene_graph=True,
+        stages=None,
+        collector=None,
+):
+    # Expands the tree stem by stem, level by level, and the stems of a
+    # level in order of importance (the radius and stem length of the
+    # segment they sprout from). Once a budget is used up, the stem being
+    # grown and all stems not grown yet are pruned, and unless
+    # `keep_partial_level` is set, so is the rest of the level that was
+    # being grown, so that the tree ends at the same level everywhere.
+    # The trunk is always grown in full. Within the budget, the tree is
+    # the same as with `expand_fully`.
+    if stages is None:
+        stages = default_stages(tropisms=tropisms, scene_graph=scene_graph)
+    deadline = None if max_seconds is None else time.perf_counter() + max_seconds
+    segments = 0
+    vertices = 0
+    # How much of that is in the stem being grown, and in the grown stems
+    # of the current level, as they may be pruned again.
+    stem_segments_grown = 0
+    stem_vertices_grown = 0
+    level_segments = 0
+    level_vertices = 0
+
+    def over_budget():
+        return (
+            (max_segments is not None and segments >= max_segments) or
+            (max_vertices is not None and vertices + 2 * circle_segments > max_vertices) or
+            (deadline is not None and time.perf_counter() > deadline)
+        )
+
+    order = itertools.count()
+    stems = [(0, 0.0, next(order), s)]  # Heap of (level, -importance, order, stem root)
+    level_stems = []  # Grown stems of the current level
+    current_level = 0
+    while stems:
+        level, _, _, stem = heapq.heappop(stems)
+        if level != current_level:
+            current_level = level
+            level_stems = []
+            level_segments = 0
+            level_vertices = 0
+
+        stem_segments = [stem]
+        stem_segments_grown = 0
+        stem_vertices_grown = 0
+        while stem_segments:
+            if level > 0 and over_budget():
+                prune_stem(stem)
+                for _, _, _, rest_stem in stems:
+                    prune_stem(rest_stem)
+                kept_segments = segments - stem_segments_grown
+                kept_vertices = vertices - stem_vertices_grown
+                levels = level
+                if keep_partial_level and level_stems:
+                    levels += 1
+                else:
+                    for grown_stem in level_stems:
+                        prune_stem(grown_stem)
+                    kept_segments -= level_segments
+                    kept_vertices -= level_vertices
+                return BudgetResult(False, levels, kept_segments, kept_vertices, segments, vertices)
+
+            segment = stem_segments.pop()
+            expand(segment, stages=stages, collector=collector)
+            segment_vertices = circle_segments
+            if segment is stem:
+                segment_vertices += circle_segments  # The foot ring
+            segments += 1
+            vertices += segment_vertices
+            stem_segments_grown += 1
+            stem_vertices_grown += segment_vertices
+            importance = segment[sg.RADIUS] * segment[sg.STEM_ROOT][sg.STEM_LENGTH]
+            for child in segment[sg.CONTINUATIONS] + segment[sg.BRANCHES]:
+                if sg.IS_NEW_BRANCH in child:
+                    heapq.heappush(stems, (level + 1, -importance, next(order), child))
+                else:
+                    stem_segments.append(child)
+        level_stems.append(stem)
+        level_segments += stem_segments_grown
+        level_vertices += stem_vertices_grown
+    return BudgetResult(True, current_level + 1, segments, vertices, segments, vertices)
+
+
+def materialize_nodes(s):
+    # Replaces the Frames of a tree expanded with `scene_graph=False` by
+    # NodePaths with the same local transforms.
+    root_frame = s[sg.TREE_ROOT_NODE]
+    if not isinstance(root_frame, Frame):
+        return
+    root_node = NodePath(root_frame.name)
+    root_node.set_pos_hpr(root_frame.pos, root_frame.hpr)
+    s[sg.TREE_ROOT_NODE] = root_node
+
     segments = [s]
     while segments:
         segment = segments.pop()
-        expand(segment, tropisms=tropisms)
+        if sg.PARENT_SEGMENT in segment:
+            parent_node = segment[sg.PARENT_SEGMENT][sg.NODE]
+        else:
+            parent_node = root_node
+        frame = segment[sg.NODE]
+        node = parent_node.attach_new_node(frame.name)
+        node.set_pos_hpr(frame.pos, frame.hpr)
+        segment[sg.NODE] = node
         segments += segment[sg.CONTINUATIONS]
         segments += segment[sg.BRANCHES]
@@ -0,0 +1,188 @@
+import random
+
+import numpy as np
+
+from panda3d.core import NodePath
+from panda3d.core import Shader
+from panda3d.core import Texture
+from panda3d.core import GeomEnums
+from panda3d.core import BoundingBox
+from panda3d.core import Point3
+
+from forest import TreeJob
+from forest import generate_forest
+
+
+# Forests of many trees of few kinds. For each bucket of tree ages, a
+# small pool of variants of a species is generated, and each placed tree
+# is drawn as an instance of one of them. The per-instance transforms
+# and tints are stored in a buffer texture that the shader reads by
+# instance ID, so draw calls and memory grow with the number of
+# variants, not the number of trees.
+
+
+# Per instance, four texels: The three rows of the affine transform from
+# tree space to forest space, and the tint.
+texels_per_instance = 4
+
+
+instance_vertex_shader = """
+#version 140
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform samplerBuffer instances;
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec4 p3d_Color;
+
+out vec3 normal;
+out vec4 color;
+
+void main() {
+    int base = gl_InstanceID * 4;
+    vec4 row_x = texelFetch(instances, base);
+    vec4 row_y = texelFetch(instances, base + 1);
+    vec4 row_z = texelFetch(instances, base + 2);
+    vec4 tint = texelFetch(instances, base + 3);
+
+    vec4 vertex = vec4(
+        dot(row_x, p3d_Vertex),
+        dot(row_y, p3d_Vertex),
+        dot(row_z, p3d_Vertex),
+        1.0
+    );
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+    normal = normalize(vec3(
+        dot(row_x.xyz, p3d_Normal),
+        dot(row_y.xyz, p3d_Normal),
+        dot(row_z.xyz, p3d_Normal)
+    ));
+    color = p3d_Color * tint;
+}
+"""
+
+
+instance_fragment_shader = """
+#version 140
+
+in vec3 normal;
+in vec4 color;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    p3d_FragColor = color;
+}
+"""
+
+
+def instance_shader():
+    return Shader.make(Shader.SL_GLSL, vertex=instance_vertex_shader, fragment=instance_fragment_shader)
+
+
+def instance_texels(positions, headings, scales, tints):
+    # (instances * texels_per_instance, 4) float32 texel data. With the
+    # heading convention of the tree code, a heading of `h` degrees turns
+    # the tree's +Y axis towards -X.
+    h = np.radians(headings)
+    cos_h = np.cos(h) * scales
+    sin_h = np.sin(h) * scales
+    zeros = np.zeros_like(cos_h)
+    texels = np.empty((len(positions), texels_per_instance, 4), dtype=np.float32)
+    texels[:, 0] = np.stack([cos_h, -sin_h, zeros, positions[:, 0]], axis=-1)
+    texels[:, 1] = np.stack([sin_h, cos_h, zeros, positions[:, 1]], axis=-1)
+    texels[:, 2] = np.stack([zeros, zeros, scales, positions[:, 2]], axis=-1)
+    texels[:, 3] = tints
+    return texels.reshape(-1, 4)
+
+
+def instance_buffer(texels):
+    texture = Texture('instances')
+    texture.setup_buffer_texture(len(texels), Texture.T_float, Texture.F_rgba32, GeomEnums.UH_static)
+    memoryview(texture.modify_ram_image()).cast('B')[:] = np.ascontiguousarray(texels).view(np.uint8).ravel()
+    return texture
+
+
+def _instance_bounds(variant_node, positions, scales):
+    # The variant's bounds, grown to cover every instance of it. Instances
+    # are turned by their heading, so in x and y, the bounds have to
+    # reach as far as the farthest corner of the variant's box does.
+    bounds = NodePath(variant_node).get_tight_bounds()
+    if bounds is None:
+        low, high = np.zeros(3), np.zeros(3)
+    else:
+        low, high = np.array(bounds[0]), np.array(bounds[1])
+    corners = np.array([[x, y] for x in (low[0], high[0]) for y in (low[1], high[1])])
+    reach = np.linalg.norm(corners, axis=-1).max() * scales
+    lows = positions + np.stack([-reach, -reach, low[2] * scales], axis=-1)
+    highs = positions + np.stack([reach, reach, high[2] * scales], axis=-1)
+    return BoundingBox(Point3(*lows.min(axis=0)), Point3(*highs.max(axis=0)))
+
+
+def age_buckets(ages, age_step):
+    return np.maximum(np.round(np.asarray(ages) / age_step), 1) * age_step
+
+
+def instanced_forest(
+        species,
+        positions,
+        ages=1.0,
+        headings=None,
+        scales=None,
+        tints=None,
+        variants=4,
+        age_step=0.25,
+        forest_seed=0,
+        heliotropic_direction=(0, 0, 1),
+        max_workers=0,
+        tropisms=True,
+        circle_segments=10,
+        bark_tris=True,
+):
+    # Places a tree of `species` at each of the (N, 3) `positions`. The
+    # optional per-tree `ages`, `headings` (degrees), `scales` and
+    # `tints` (RGBA) are scalars or arrays of length N; By default, trees
+    # get random headings. Ages are rounded to multiples of `age_step`.
+    # Returns a NodePath with one instanced node per age bucket and
+    # variant. `max_workers` is passed to `forest.generate_forest`.
+    positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    count = len(positions)
+    rng = random.Random(forest_seed)
+    if headings is None:
+        headings = [rng.uniform(0.0, 360.0) for _ in range(count)]
+    headings = np.broadcast_to(np.asarray(headings, dtype=np.float32), (count, ))
+    scales = np.broadcast_to(np.asarray(1.0 if scales is None else scales, dtype=np.float32), (count, ))
+    tints = np.broadcast_to(np.asarray((1, 1, 1, 1) if tints is None else tints, dtype=np.float32), (count, 4))
+    buckets = np.broadcast_to(age_buckets(ages, age_step), (count, ))
+    choices = np.array([rng.randrange(variants) for _ in range(count)], dtype=np.int64)
+
+    # One job per age bucket and variant, all generated in one go.
+    jobs = []
+    for age in np.unique(buckets).tolist():
+        for variant in range(variants):
+            seed = rng.randint(0, 2**31 - 1)
+            jobs.append(TreeJob(species, seed, age, heliotropic_direction))
+    nodes = generate_forest(
+        jobs,
+        max_workers=max_workers,
+        tropisms=tropisms,
+        circle_segments=circle_segments,
+        bark_tris=bark_tris,
+    )
+
+    forest = NodePath('instanced_forest')
+    forest.set_shader(instance_shader())
+    for idx, (job, node) in enumerate(zip(jobs, nodes)):
+        selected = (buckets == job.age) & (choices == idx % variants)
+        if not selected.any():
+            continue
+        texels = instance_texels(positions[selected], headings[selected], scales[selected], tints[selected])
+        bounds = _instance_bounds(node, positions[selected], scales[selected])
+        node.set_name('age_{}_variant_{}'.format(job.age, idx % variants))
+        variant = forest.attach_new_node(node)
+        variant.set_instance_count(int(selected.sum()))
+        variant.set_shader_input('instances', instance_buffer(texels))
+        node.set_bounds(bounds)
+        node.set_final(True)
+    return forest
@@ -0,0 +1,132 @@
+import math
+import random
+
+import numpy as np
+
+from panda3d.core import CullFaceAttrib
+
+from tree_specs import StemDefinition as sd
+from segment_store import SegmentStore
+from segment_store import store_from_tree
+import geometry
+
+
+# Leaves are not segments; There are far too many of them. Instead, they
+# are placed in one batch along the stems whose definitions have a
+# LEAF_DENSITY, using the final frames of the segments, and all leaves
+# of a tree become quads in a single GeomNode.
+#
+# Around the stem, leaves are spaced by the golden angle, with a bit of
+# jitter. They stand off the stem at LEAF_ANGLE degrees (0 pointing
+# along the stem, 90 straight outwards), and are LEAF_SIZE long and
+# wide.
+
+
+golden_angle = math.pi * (3.0 - math.sqrt(5.0))
+leaf_color = (51, 128, 38, 255)
+
+
+def _evaluate(func, age, ratios, rng):
+    if hasattr(func, 'batchable') and func.batchable():
+        return np.asarray(func.batch(age, ratios, None), dtype=np.float64)
+    return np.array([func(age, ratio, rng) for ratio in ratios.tolist()], dtype=np.float64)
+
+
+def leaf_frames(store):
+    # Returns the bases, directions, sides and sizes of all leaves, as
+    # arrays in the tree root's space.
+    random_source = random.Random(store.seed)
+    np_rng = np.random.default_rng(random_source.getrandbits(64))
+    bases = []
+    directions = []
+    sides = []
+    sizes = []
+    for def_idx, definition in enumerate(store.definitions):
+        if sd.LEAF_DENSITY not in definition:
+            continue
+        rows = np.nonzero(store.definition == def_idx)[0]
+        if len(rows) == 0:
+            continue
+        segments = definition[sd.SEGMENTS]
+        start_ratios = (segments - store.rest_segments[rows] - 1) / segments
+
+        # Leaves per segment, with fractions resolved randomly.
+        density = _evaluate(definition[sd.LEAF_DENSITY], store.age, start_ratios, random_source)
+        counts = np.floor(density + np_rng.random(len(rows))).astype(np.int64)
+        counts = np.maximum(counts, 0)
+        leaf_rows = np.repeat(rows, counts)
+        if len(leaf_rows) == 0:
+            continue
+
+        # Position of each leaf along its segment, and its ratio in the stem
+        along = np_rng.random(len(leaf_rows))
+        ratios = np.repeat(start_ratios, counts) + along / segments
+        leaf_sizes = _evaluate(definition[sd.LEAF_SIZE], store.age, ratios, random_source)
+        if sd.LEAF_ANGLE in definition:
+            angles = _evaluate(definition[sd.LEAF_ANGLE], store.age, ratios, random_source)
+        else:
+            angles = np.full(len(leaf_rows), 45.0)
+
+        # Frames of the segments the leaves grow on
+        mats = store.transform[leaf_rows].astype(np.float64)
+        axis_x = mats[:, 0, :3]
+        axis_y = mats[:, 1, :3]
+        axis_z = mats[:, 2, :3]
+        tops = mats[:, 3, :3]
+        lengths = store.length[leaf_rows][:, None]
+        radii = store.radius[leaf_rows][:, None]
+
+        headings = np.arange(len(leaf_rows)) * golden_angle + np_rng.normal(0.0, 0.3, len(leaf_rows))
+        radial = np.cos(headings)[:, None] * axis_x + np.sin(headings)[:, None] * axis_y
+        pitch = np.radians(angles)[:, None]
+        bases.append(tops - axis_z * lengths * (1.0 - along[:, None]) + radial * radii)
+        directions.append(np.cos(pitch) * axis_z + np.sin(pitch) * radial)
+        sides.append(np.cross(axis_z, radial))
+        sizes.append(leaf_sizes)
+
+    if not bases:
+        empty = np.zeros((0, 3))
+        return empty, empty, empty, np.zeros(0)
+    return np.concatenate(bases), np.concatenate(directions), np.concatenate(sides), np.concatenate(sizes)
+
+
+def leaf_vertices(bases, directions, sides, sizes):
+    # Four vertices per leaf: The two at the base, then the two at the tip.
+    half_widths = (sides * sizes[:, None] / 2.0)[:, None, :]
+    lengths = (directions * sizes[:, None])[:, None, :]
+    corners = np.array([[-1.0, 0.0], [1.0, 0.0], [-1.0, 1.0], [1.0, 1.0]])
+    points = bases[:, None, :] + half_widths * corners[None, :, 0:1] + lengths * corners[None, :, 1:2]
+    normals = np.cross(sides, directions)
+
+    vertices = np.empty(len(bases) * 4, dtype=geometry.vertex_dtype)
+    vertices['vertex'] = points.reshape(-1, 3)
+    vertices['normal'] = np.repeat(normals, 4, axis=0)
+    vertices['color'] = leaf_color
+    return vertices
+
+
+def leaf_indices(count, bark_tris=True):
+    offsets = np.arange(count, dtype=np.uint32)[:, None] * 4
+    if bark_tris:
+        pattern = np.array([0, 1, 2, 3, 2, 1], dtype=np.uint32)
+    else:
+        pattern = np.array([0, 1, 1, 3, 3, 2, 2, 0], dtype=np.uint32)
+    return (offsets + pattern[None, :]).ravel()
+
+
+def leaf_geom_node(tree, bark_tris=True, name='leaves'):
+    # `tree` is an expanded tree, or a SegmentStore. Returns a GeomNode
+    # with all the tree's leaves, rendered two-sided, or None if the tree
+    # has no leaves.
+    if isinstance(tree, SegmentStore):
+        store = tree
+    else:
+        store = store_from_tree(tree)
+    bases, directions, sides, sizes = leaf_frames(store)
+    if len(bases) == 0:
+        return None
+    vertices = leaf_vertices(bases, directions, sides, sizes)
+    indices = leaf_indices(len(bases), bark_tris)
+    node = geometry.make_geom_node(vertices, indices, bark_tris, name=name)
+    node.set_attrib(CullFaceAttrib.make(CullFaceAttrib.M_cull_none))
+    return node
@@ -0,0 +1,223 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from panda3d.core import LODNode
+from panda3d.core import NodePath
+from panda3d.core import CardMaker
+from panda3d.core import Camera
+from panda3d.core import OrthographicLens
+from panda3d.core import TransparencyAttrib
+
+from segment_store import SegmentStore
+from segment_store import store_from_tree
+import geometry
+
+
+# Levels of detail for a tree, all built from the same expansion. Each
+# level is meshed with fewer vertices per ring, leaves out rings between
+# segments of a stem that continue in (nearly) the same direction, and
+# drops thin and short stems entirely (along with everything growing on
+# them). After the last level, the tree can be replaced by a billboard
+# showing a rendered image of it.
+
+
+# distance: Distance up to which this level is shown; It is shown from
+#     the previous level's distance on.
+# circle_segments: Vertices per ring.
+# merge_angle: Rings between two segments of a stem are left out if the
+#     segments' directions differ by less than this many degrees.
+# min_radius: Stems whose first segment is thinner than this are dropped.
+# min_stem_length: Stems shorter than this are dropped.
+LODLevel = namedtuple(
+    'LODLevel',
+    'distance circle_segments merge_angle min_radius min_stem_length',
+)
+
+
+default_levels = [
+    LODLevel(30.0, 10, 0.0, 0.0, 0.0),
+    LODLevel(80.0, 6, 10.0, 0.02, 0.5),
+    LODLevel(200.0, 3, 25.0, 0.05, 1.5),
+]
+
+
+def kept_segments(store, min_radius, min_stem_length):
+    stems = store.stem
+    stem_lengths = np.array(
+        [store.stem_lengths[stem] for stem in stems.tolist()],
+        dtype=np.float32,
+    )
+    keep = (store.radius[stems] >= min_radius) & (stem_lengths >= min_stem_length)
+    keep |= store.level == 0  # The trunk always stays.
+
+    # Segments growing on dropped segments are dropped, too.
+    has_parent = store.parent >= 0
+    while True:
+        parent_kept = np.ones(len(store), dtype=bool)
+        parent_kept[has_parent] = keep[store.parent[has_parent]]
+        new_keep = keep & parent_kept
+        if (new_keep == keep).all():
+            return keep
+        keep = new_keep
+
+
+def merged_segments(store, keep, merge_angle):
+    # Segments whose top ring can be left out: Those with exactly one
+    # kept continuation in the same stem, which goes on in about the
+    # same direction as the stem did at the last ring that was kept, so
+    # that bends can't add up along a run of merged segments.
+    merged = np.zeros(len(store), dtype=bool)
+    if merge_angle <= 0.0:
+        return merged
+    stem_root = store.is_stem_root()
+    continuation = ~stem_root & keep
+    children = store.parent[continuation]
+    num_continuations = np.bincount(children, minlength=len(store))
+    only_child = np.full(len(store), -1, dtype=np.int64)
+    only_child[children] = np.nonzero(continuation)[0]
+    only_child[num_continuations != 1] = -1
+    directions = store.transform[:, 2, :3]
+    directions = directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+    min_cos = math.cos(math.radians(merge_angle))
+
+    # The segment that starts at the last kept ring below each segment;
+    # Parents come before their children in the store.
+    run_start = np.arange(len(store))
+    parents = store.parent.tolist()
+    for idx in np.nonzero(keep)[0].tolist():
+        if not stem_root[idx] and merged[parents[idx]]:
+            run_start[idx] = run_start[parents[idx]]
+        child = only_child[idx]
+        if child >= 0 and np.dot(directions[run_start[idx]], directions[child]) >= min_cos:
+            merged[idx] = True
+    return merged
+
+
+def simplified_rings(store, keep, merged):
+    # Like `geometry.store_rings`, but only for kept segments, and with
+    # the top rings of merged segments left out.
+    mats = []
+    radii = []
+    z_offsets = []
+    twists = []
+    rest_segments = []
+    connections = []
+    identity = np.identity(4, dtype=np.float32)
+
+    def add_ring(idx, mat, z_offset):
+        mats.append(mat)
+        radii.append(store.radius[idx])
+        z_offsets.append(z_offset)
+        twists.append(store.twist[idx])
+        rest_segments.append(store.rest_segments[idx])
+        return len(mats) - 1
+
+    # The ring that children of a segment connect to.
+    top_ring = {}
+    stem_root = store.is_stem_root()
+    for idx in np.nonzero(keep)[0].tolist():
+        if store.parent[idx] == -1:
+            bottom_ring = add_ring(idx, identity, 0.0)
+        elif stem_root[idx]:
+            bottom_ring = add_ring(idx, store.transform[idx], -store.length[idx])
+        else:
+            bottom_ring = top_ring[int(store.parent[idx])]
+        if merged[idx]:
+            top_ring[idx] = bottom_ring
+        else:
+            top_ring[idx] = add_ring(idx, store.transform[idx], 0.0)
+            connections.append((top_ring[idx], bottom_ring))
+
+    return geometry.Rings(
+        mats=np.array(mats, dtype=np.float32).reshape(-1, 4, 4),
+        radii=np.array(radii, dtype=np.float32),
+        z_offsets=np.array(z_offsets, dtype=np.float32),
+        twists=np.array(twists, dtype=np.float32),
+        rest_segments=np.array(rest_segments, dtype=np.int64),
+        connections=np.array(connections, dtype=np.uint32).reshape(-1, 2),
+    )
+
+
+def level_geom_node(store, level, bark_tris=True, name='lod_level'):
+    keep = kept_segments(store, level.min_radius, level.min_stem_length)
+    merged = merged_segments(store, keep, level.merge_angle)
+    rings = simplified_rings(store, keep, merged)
+    vertices = geometry.ring_vertices(rings, level.circle_segments)
+    indices = geometry.bark_indices(rings, level.circle_segments, bark_tris)
+    return geometry.make_geom_node(vertices, indices, bark_tris, name=name)
+
+
+def impostor_extents(store):
+    # How far the tree reaches out from its vertical axis, and down and
+    # up. The impostor card and its texture both cover this, so the
+    # texture fits the card.
+    points = store.transform[:, 3, :3]
+    max_radius = float(store.radius.max(initial=0.0))
+    half_width = float(np.linalg.norm(points[:, :2], axis=-1).max(initial=0.0)) + max_radius
+    bottom = min(0.0, float(points[:, 2].min(initial=0.0)))
+    top = float(points[:, 2].max(initial=0.0)) + max_radius
+    return half_width, bottom, top
+
+
+def impostor_card(store, texture):
+    # A card that always faces the camera, covering the tree's extent,
+    # showing `texture` (see `render_impostor_texture`).
+    half_width, bottom, top = impostor_extents(store)
+    card_maker = CardMaker('impostor')
+    card_maker.set_frame(-half_width, half_width, bottom, top)
+    card = NodePath(card_maker.generate())
+    card.set_billboard_axis()
+    card.set_texture(texture)
+    card.set_transparency(TransparencyAttrib.M_binary)
+    return card
+
+
+def render_impostor_texture(tree_node, store, window, size=128):
+    # Renders `tree_node`, the mesh of `store`, from the side into a
+    # texture for `impostor_card(store, texture)`, using an offscreen
+    # buffer of the graphics `window` (e.g. `base.win`).
+    tree = NodePath(tree_node)
+    half_width, bottom, top = impostor_extents(store)
+
+    buffer = window.make_texture_buffer('impostor_buffer', size, size, to_ram=True)
+    buffer.set_clear_color((0, 0, 0, 0))
+    scene = NodePath('impostor_scene')
+    tree.instance_to(scene)
+    lens = OrthographicLens()
+    lens.set_film_size(half_width * 2.0, top - bottom)
+    lens.set_film_offset(0, (top + bottom) / 2.0)
+    lens.set_near_far(0.5, half_width * 2.0 + 1.5)
+    camera = scene.attach_new_node(Camera('impostor_camera', lens))
+    camera.set_y(-half_width - 1.0)
+    buffer.make_display_region().set_camera(camera)
+
+    engine = window.get_engine()
+    engine.render_frame()
+    engine.render_frame()
+    texture = buffer.get_texture()
+    engine.remove_window(buffer)
+    return texture
+
+
+def lod_node(tree, levels=default_levels, impostor_distance=1000.0, impostor_texture=None, bark_tris=True):
+    # `tree` is an expanded tree, or a SegmentStore. Returns a NodePath
+    # with an LODNode that has one child per level, plus, if an
+    # `impostor_texture` is given, the impostor up to `impostor_distance`.
+    if isinstance(tree, SegmentStore):
+        store = tree
+    else:
+        store = store_from_tree(tree)
+
+    lod = NodePath(LODNode('tree_lod'))
+    near = 0.0
+    for idx, level in enumerate(levels):
+        node = level_geom_node(store, level, bark_tris, name='lod_level_{}'.format(idx))
+        lod.attach_new_node(node)
+        lod.node().add_switch(level.distance, near)
+        near = level.distance
+    if impostor_texture is not None:
+        impostor_card(store, impostor_texture).reparent_to(lod)
+        lod.node().add_switch(impostor_distance, near)
+    return lod
@@ -0,0 +1,170 @@
+import os
+import enum
+import mmap
+import struct
+import hashlib
+import tempfile
+import types
+
+from panda3d.core import LVecBase3f
+
+import geometry
+from blending_functions import BlendingFunction
+from forest import TreeJob
+from forest import resolve_species
+from forest import tree_buffers
+from forest import buffers_to_geom_node
+
+
+# A content-addressed on-disk cache of finished tree meshes. Keys are
+# derived from everything that goes into a tree: The species definition
+# (including the parameters captured in its blending functions), seed,
+# age, heliotropic direction and the meshing parameters. Entries are
+# flat files of vertex and index data that are memory-mapped on load.
+# When the cache grows beyond `max_bytes`, the least recently used
+# entries are removed.
+
+
+FORMAT_VERSION = 2
+header = struct.Struct('<4sIIII')  # magic, version, vertices, indices, bark_tris
+magic = b'TMSH'
+suffix = '.mesh'
+
+
+def _fingerprint_parts(obj):
+    # A canonical, nested representation of `obj`, from which a stable
+    # hash can be computed.
+    if isinstance(obj, dict):
+        items = [(_fingerprint_parts(k), _fingerprint_parts(v)) for k, v in obj.items()]
+        return ('dict', tuple(sorted(items, key=repr)))
+    elif isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, tuple(_fingerprint_parts(o) for o in obj))
+    elif isinstance(obj, BlendingFunction):
+        return ('blending', _fingerprint_parts(obj.to_dict()))
+    elif isinstance(obj, enum.Enum):
+        return ('enum', type(obj).__name__, obj.name)
+    elif isinstance(obj, types.FunctionType):
+        closure = obj.__closure__ or ()
+        return (
+            'function',
+            obj.__module__,
+            obj.__qualname__,
+            hashlib.sha256(obj.__code__.co_code).hexdigest(),
+            _fingerprint_parts(obj.__defaults__ or ()),
+            tuple(_fingerprint_parts(cell.cell_contents) for cell in closure),
+        )
+    elif isinstance(obj, LVecBase3f):
+        return ('vec3', tuple(repr(float(c)) for c in obj))
+    elif isinstance(obj, float):
+        return ('float', repr(obj))
+    elif obj is None or isinstance(obj, (bool, int, str, bytes)):
+        return (type(obj).__name__, repr(obj))
+    else:
+        raise TypeError("Can't fingerprint {!r}".format(obj))
+
+
+def fingerprint(obj):
+    return hashlib.sha256(repr(_fingerprint_parts(obj)).encode('utf-8')).hexdigest()
+
+
+def job_key(job, tropisms=True, circle_segments=10, bark_tris=True):
+    job = TreeJob(*job)
+    return fingerprint(
+        (
+            FORMAT_VERSION,
+            resolve_species(job.species),
+            job.seed,
+            float(job.age),
+            tuple(float(c) for c in job.heliotropic_direction),
+            tropisms,
+            circle_segments,
+            bark_tris,
+        ),
+    )
+
+
+class MeshCache:
+    def __init__(self, directory, max_bytes=256 * 1024**2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + suffix)
+
+    def _entries(self):
+        entries = [
+            entry for entry in os.scandir(self.directory)
+            if entry.is_file() and entry.name.endswith(suffix)
+        ]
+        return [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries]
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._discard(path)
+            total -= size
+
+    def put(self, key, buffers, bark_tris=True):
+        vertex_bytes, index_bytes = buffers
+        num_vertices = len(vertex_bytes) // geometry.vertex_dtype.itemsize
+        num_indices = len(index_bytes) // 4
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.pack(magic, FORMAT_VERSION, num_vertices, num_indices, int(bark_tris)))
+            f.write(vertex_bytes)
+            f.write(index_bytes)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def get_geom_node(self, key, name='geom_node'):
+        # Returns None on a cache miss. Entries that are broken (e.g.
+        # truncated by a crash) count as misses, and are removed.
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    tag, version, num_vertices, num_indices, bark_tris = header.unpack_from(view)
+                    vertex_start = header.size
+                    index_start = vertex_start + num_vertices * geometry.vertex_dtype.itemsize
+                    index_end = index_start + num_indices * 4
+                    if tag != magic or version != FORMAT_VERSION or len(view) != index_end:
+                        node = None
+                    else:
+                        buffers = (view[vertex_start:index_start], view[index_start:index_end])
+                        node = buffers_to_geom_node(buffers, bool(bark_tris), name=name)
+                        del buffers
+        except (ValueError, struct.error):
+            # mmap refuses empty files, and the header may be cut short.
+            node = None
+        if node is None:
+            self._discard(path)
+            return None
+        os.utime(path)  # Mark as recently used.
+        return node
+
+    def tree_geom_node(self, job, tropisms=True, circle_segments=10, bark_tris=True):
+        # Expands and meshes the tree of `job`, unless it is cached.
+        key = job_key(job, tropisms, circle_segments, bark_tris)
+        node = self.get_geom_node(key)
+        if node is None:
+            buffers = tree_buffers(TreeJob(*job), tropisms, circle_segments, bark_tris)
+            self.put(key, buffers, bark_tris)
+            node = buffers_to_geom_node(buffers, bark_tris)
+        return node
@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from tree_specs import Segment as sg
+from homebrew import default_stages
+from homebrew import expand
+from homebrew import expand_iter
+from segment_store import SegmentStore
+
+
+# Expanding the branches of a tree in parallel. Once the trunk is grown,
+# its branches don't depend on each other anymore, and (with the counter
+# based RNG) their random numbers only depend on where they sprout. So
+# the trunk is grown in this process, each branch is grown into a
+# SegmentStore of its own in a process pool, and the stores are stitched
+# back together in the order in which `expand_fully` would have
+# recorded the segments, giving the very same SegmentStore.
+
+
+def _subtree_payload(branch):
+    # Just what the stages read from a branch's parent and the tree's
+    # root. The parent's Frame brings along its chain up to the tree's
+    # root Frame.
+    parent = branch[sg.PARENT_SEGMENT]
+    tree_root = branch[sg.TREE_ROOT]
+    root_stub = {
+        key: tree_root[key]
+        for key in [sg.DEFINITION, sg.AGE, sg.HELIOTROPIC_DIRECTION, sg.TREE_ROOT_NODE]
+    }
+    parent_stub = {
+        sg.TREE_ROOT: root_stub,
+        sg.STEM_ROOT: {sg.DEFINITION: parent[sg.STEM_ROOT][sg.DEFINITION]},
+        sg.STEM_PLAN: parent[sg.STEM_PLAN],
+        sg.NODE: parent[sg.NODE],
+        sg.LENGTH: parent[sg.LENGTH],
+        sg.REST_SEGMENTS: parent[sg.REST_SEGMENTS],
+    }
+    branch_stub = {
+        key: branch[key]
+        for key in [sg.RNG_SEED, sg.IS_NEW_BRANCH, sg.DEFINITION]
+    }
+    branch_stub[sg.TREE_ROOT] = root_stub
+    branch_stub[sg.PARENT_SEGMENT] = parent_stub
+    return branch_stub
+
+
+def expand_subtree(args):
+    # Runs in the worker processes.
+    branch, tropisms = args
+    store = SegmentStore()
+    store.add_anchor(branch[sg.PARENT_SEGMENT], level=0)
+    segments = expand_iter(branch, tropisms=tropisms, scene_graph=False, release_segments=True)
+    for segment in segments:
+        store.add(segment)
+    return store
+
+
+def expand_parallel(s, store=None, max_workers=None, tropisms=True):
+    # Like `expand_fully(s, tropisms=tropisms, scene_graph=False,
+    # store=store)`, with the trunk's branches expanded in a process pool
+    # of `max_workers` processes, or in this process with
+    # `max_workers=0`. Returns the store.
+    if store is None:
+        store = SegmentStore()
+    stages = default_stages(tropisms=tropisms, scene_graph=False)
+
+    # Grow the trunk, noting where in the order of segments each branch's
+    # subtree will go.
+    order = []
+    branches = []
+    segments = [s]
+    while segments:
+        segment = segments.pop()
+        if sg.IS_NEW_BRANCH in segment:
+            order.append(len(branches))
+            branches.append(segment)
+            continue
+        expand(segment, stages=stages)
+        order.append(segment)
+        segments += segment[sg.CONTINUATIONS]
+        segments += segment[sg.BRANCHES]
+
+    args = [(_subtree_payload(branch), tropisms) for branch in branches]
+    if max_workers == 0:
+        subtrees = [expand_subtree(a) for a in args]
+    else:
+        workers = max_workers or os.cpu_count() or 1
+        chunksize = max(1, len(args) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            subtrees = list(executor.map(expand_subtree, args, chunksize=chunksize))
+
+    for entry in order:
+        if isinstance(entry, int):
+            branch = branches[entry]
+            store.append_subtree(subtrees[entry], branch[sg.PARENT_SEGMENT][sg.STORE_INDEX])
+        else:
+            store.add(entry)
+    return store
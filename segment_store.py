@@ -0,0 +1,378 @@
+import enum
+from collections.abc import Mapping
+
+import numpy as np
+
+from panda3d.core import Vec3
+
+from tree_specs import StemDefinition as sd
+from tree_specs import Segment as sg
+from frames import Frame
+
+
+# A SegmentStore holds an expanded tree as a structure of arrays, one
+# row per segment, in the order in which `homebrew.expand_fully`
+# expands them (so parents always come before their children). Pass one
+# to `expand_fully` to have it recorded there, and the segment dicts
+# (and their RNGs) are dropped as soon as they are not needed anymore.
+#
+# `store[idx]` returns a read-only view of a row that behaves like the
+# segment dict that it was recorded from, for code that walks trees.
+
+
+class SegmentFlag(enum.IntFlag):
+    TREE_ROOT  = 1
+    NEW_SPLIT  = 2
+    NEW_BRANCH = 4
+
+
+columns = {
+    'parent':          (np.int32, ()),       # Row of the parent segment, -1 for the tree's root
+    'stem':            (np.int32, ()),       # Row of the stem's first segment
+    'level':           (np.uint8, ()),       # 0 for the trunk, 1 for its branches, ...
+    'definition':      (np.uint16, ()),      # Index into SegmentStore.definitions
+    'rng_seed':        (np.uint64, ()),      # The tree root's seed is SegmentStore.seed
+    'rest_segments':   (np.int32, ()),
+    'length':          (np.float32, ()),
+    'radius':          (np.float32, ()),
+    'pos':             (np.float32, (3, )),  # Local transform relative to the parent segment
+    'hpr':             (np.float32, (3, )),
+    'transform':       (np.float32, (4, 4)), # Net transform relative to the tree's root
+    'twist':           (np.float32, ()),     # Heading accumulated since the stem's root.
+    'flags':           (np.uint8, ()),
+    'split_index':     (np.int16, ()),       # IS_NEW_SPLIT
+    'split_count':     (np.int16, ()),
+    'branch_position': (np.float32, ()),     # IS_NEW_BRANCH
+    'branch_ratio':    (np.float32, ()),     # BRANCH_RATIO
+}
+
+
+def _column(name):
+    return property(lambda self: self._columns[name][:self.size])
+
+
+class SegmentStore:
+    def __init__(self, capacity=256):
+        self.size = 0
+        self._columns = {
+            name: np.zeros((capacity, ) + shape, dtype=dtype)
+            for name, (dtype, shape) in columns.items()
+        }
+        self.definitions = []
+        self._definition_indices = {}
+        self.stem_lengths = {}  # stem root row -> STEM_LENGTH
+        # Tree-wide values, as found on the tree's root.
+        self.seed = None
+        self.age = None
+        self.heliotropic_direction = None
+        self.tree_length = None
+        self.root_radius = None
+        # Caches for the dict-like accessors
+        self._children = None
+        self._frames = {}
+
+    parent = _column('parent')
+    stem = _column('stem')
+    level = _column('level')
+    definition = _column('definition')
+    rng_seed = _column('rng_seed')
+    rest_segments = _column('rest_segments')
+    length = _column('length')
+    radius = _column('radius')
+    pos = _column('pos')
+    hpr = _column('hpr')
+    transform = _column('transform')
+    twist = _column('twist')
+    flags = _column('flags')
+    split_index = _column('split_index')
+    split_count = _column('split_count')
+    branch_position = _column('branch_position')
+    branch_ratio = _column('branch_ratio')
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if not -self.size <= idx < self.size:
+            raise IndexError(idx)
+        return SegmentView(self, idx % self.size)
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self._columns.values())
+
+    def _grow(self):
+        for name, column in self._columns.items():
+            grown = np.zeros((len(column) * 2, ) + column.shape[1:], dtype=column.dtype)
+            grown[:len(column)] = column
+            self._columns[name] = grown
+
+    def _definition_index(self, definition):
+        key = id(definition)
+        if key not in self._definition_indices:
+            self._definition_indices[key] = len(self.definitions)
+            self.definitions.append(definition)
+        return self._definition_indices[key]
+
+    def add(self, s):
+        # Records an expanded segment dict. Its parent has to be recorded
+        # already.
+        if self.size == len(self._columns['parent']):
+            self._grow()
+        idx = self.size
+        self.size += 1
+        self._children = None
+        c = self._columns
+
+        if sg.TREE_ROOT_NODE in s:
+            root_node = s[sg.TREE_ROOT_NODE]
+            flags = SegmentFlag.TREE_ROOT
+            parent = -1
+            level = 0
+            self.seed = s[sg.RNG_SEED]
+            self.age = s[sg.AGE]
+            self.heliotropic_direction = Vec3(s[sg.HELIOTROPIC_DIRECTION])
+            self.tree_length = s[sg.TREE_LENGTH]
+            self.root_radius = s[sg.ROOT_RADIUS]
+        else:
+            root_node = s[sg.TREE_ROOT][sg.TREE_ROOT_NODE]
+            flags = SegmentFlag(0)
+            parent = s[sg.PARENT_SEGMENT][sg.STORE_INDEX]
+            level = c['level'][parent]
+            c['rng_seed'][idx] = s[sg.RNG_SEED]
+        if sg.IS_NEW_SPLIT in s:
+            flags |= SegmentFlag.NEW_SPLIT
+            c['split_index'][idx], c['split_count'][idx] = s[sg.IS_NEW_SPLIT]
+        if sg.IS_NEW_BRANCH in s:
+            flags |= SegmentFlag.NEW_BRANCH
+            level += 1
+            c['branch_position'][idx] = s[sg.IS_NEW_BRANCH]
+            c['branch_ratio'][idx] = s[sg.BRANCH_RATIO]
+        if s[sg.STEM_ROOT] is s:
+            self.stem_lengths[idx] = s[sg.STEM_LENGTH]
+            c['twist'][idx] = 0.0
+        else:
+            c['twist'][idx] = c['twist'][parent] + s[sg.NODE].get_h()
+
+        node = s[sg.NODE]
+        s[sg.STORE_INDEX] = idx
+        c['parent'][idx] = parent
+        c['stem'][idx] = s[sg.STEM_ROOT][sg.STORE_INDEX]
+        c['level'][idx] = level
+        c['definition'][idx] = self._definition_index(s[sg.STEM_ROOT][sg.DEFINITION])
+        c['rest_segments'][idx] = s[sg.REST_SEGMENTS]
+        c['length'][idx] = s[sg.LENGTH]
+        c['radius'][idx] = s[sg.RADIUS]
+        c['pos'][idx] = node.get_pos()
+        c['hpr'][idx] = node.get_hpr()
+        mat = node.get_mat(root_node)
+        c['transform'][idx] = [mat.get_row(0), mat.get_row(1), mat.get_row(2), mat.get_row(3)]
+        c['flags'][idx] = flags
+        return idx
+
+    # Subtrees
+    #
+    # To expand a subtree on its own (e.g. in another process), its
+    # parent segment is recorded as an anchor into a new store, and the
+    # subtree is recorded after it as usual. `append_subtree` then adds
+    # the subtree's rows to the store holding the real parent.
+
+    def add_anchor(self, s, level):
+        # Records a stand-in for a segment that is expanded elsewhere;
+        # Only its row and level are used.
+        if self.size == len(self._columns['parent']):
+            self._grow()
+        idx = self.size
+        self.size += 1
+        self._children = None
+        self._columns['parent'][idx] = -1
+        self._columns['level'][idx] = level
+        self._columns['definition'][idx] = self._definition_index(s[sg.STEM_ROOT][sg.DEFINITION])
+        s[sg.STORE_INDEX] = idx
+        return idx
+
+    def append_subtree(self, other, parent):
+        # Appends the rows of `other` after its anchor in row 0, with the
+        # anchor standing for row `parent`. Definitions are matched by
+        # how deep they are nested below the anchor's.
+        offset = self.size - 1
+        count = other.size - 1
+        while self.size + count > len(self._columns['parent']):
+            self._grow()
+        rows = slice(self.size, self.size + count)
+        for name in columns:
+            self._columns[name][rows] = getattr(other, name)[1:]
+        c = self._columns
+        c['parent'][rows] = np.where(other.parent[1:] == 0, parent, other.parent[1:] + offset)
+        c['stem'][rows] += offset
+
+        # Definitions, registered in the order of first use, as `add`
+        # would have.
+        definition = self.definitions[self.definition[parent]]
+        other_definition = other.definitions[other.definition[0]]
+        matching = {}
+        while True:
+            matching[id(other_definition)] = definition
+            if sd.CHILD_DEFINITION not in definition:
+                break
+            definition = definition[sd.CHILD_DEFINITION]
+            other_definition = other_definition[sd.CHILD_DEFINITION]
+        used, first_rows = np.unique(other.definition[1:], return_index=True)
+        remap = np.zeros(len(other.definitions), dtype=np.uint16)
+        for other_idx in used[np.argsort(first_rows)].tolist():
+            other_definition = other.definitions[other_idx]
+            remap[other_idx] = self._definition_index(matching[id(other_definition)])
+        c['definition'][rows] = remap[other.definition[1:]]
+
+        for idx, length in other.stem_lengths.items():
+            self.stem_lengths[idx + offset] = length
+        self.size += count
+        self._children = None
+        return offset + 1
+
+    # Navigation
+
+    def children(self, idx):
+        # Rows of the segments sprouting from `idx`, in the order in
+        # which they were listed in its CONTINUATIONS.
+        if self._children is None:
+            parents = self.parent
+            order = np.argsort(parents, kind='stable')
+            bounds = np.searchsorted(parents[order], np.arange(-1, self.size + 1))
+            self._children = (order, bounds)
+        order, bounds = self._children
+        # bounds[v + 1] is where the children of row v start.
+        return order[bounds[idx + 1]:bounds[idx + 2]][::-1].tolist()
+
+    def frame(self, idx):
+        # A Frame with the recorded local transform, attached to the
+        # Frame of its parent.
+        if idx not in self._frames:
+            if idx == -1:
+                frame = Frame('tree_root')
+            else:
+                frame = self.frame(int(self.parent[idx])).attach_new_node('tree_segment orientation')
+                frame.pos = Vec3(*self.pos[idx])
+                frame.hpr = Vec3(*self.hpr[idx])
+            self._frames[idx] = frame
+        return self._frames[idx]
+
+    def is_stem_root(self):
+        return (self.flags & (SegmentFlag.TREE_ROOT | SegmentFlag.NEW_BRANCH)) != 0
+
+
+def store_from_tree(stem, store=None):
+    # Records an already expanded tree of segment dicts.
+    if store is None:
+        store = SegmentStore()
+    segments = [stem]
+    while segments:
+        s = segments.pop()
+        store.add(s)
+        segments += s[sg.CONTINUATIONS]
+        segments += s[sg.BRANCHES]
+    return store
+
+
+class SegmentView(Mapping):
+    __slots__ = ('store', 'idx')
+
+    def __init__(self, store, idx):
+        self.store = store
+        self.idx = idx
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, SegmentView) and
+            other.store is self.store and
+            other.idx == self.idx
+        )
+
+    def __hash__(self):
+        return hash((id(self.store), self.idx))
+
+    def _flag(self, flag):
+        return bool(self.store.flags[self.idx] & flag)
+
+    def _is_stem_root(self):
+        return self._flag(SegmentFlag.TREE_ROOT | SegmentFlag.NEW_BRANCH)
+
+    def _keys(self):
+        keys = [
+            sg.RNG_SEED, sg.TREE_ROOT, sg.STEM_ROOT, sg.CONTINUATIONS,
+            sg.BRANCHES, sg.REST_SEGMENTS, sg.NODE, sg.LENGTH, sg.RADIUS,
+            sg.STORE_INDEX,
+        ]
+        if self._flag(SegmentFlag.TREE_ROOT):
+            keys += [
+                sg.AGE, sg.HELIOTROPIC_DIRECTION, sg.TREE_ROOT_NODE,
+                sg.TREE_LENGTH, sg.ROOT_RADIUS,
+            ]
+        else:
+            keys.append(sg.PARENT_SEGMENT)
+        if self._is_stem_root():
+            keys += [sg.DEFINITION, sg.STEM_LENGTH]
+        if self._flag(SegmentFlag.NEW_SPLIT):
+            keys.append(sg.IS_NEW_SPLIT)
+        if self._flag(SegmentFlag.NEW_BRANCH):
+            keys += [sg.IS_NEW_BRANCH, sg.BRANCH_RATIO]
+        return keys
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __contains__(self, key):
+        return key in self._keys()
+
+    def __getitem__(self, key):
+        if key not in self._keys():
+            raise KeyError(key)
+        store = self.store
+        idx = self.idx
+        if key == sg.RNG_SEED:
+            if idx == 0:
+                return store.seed
+            return int(store.rng_seed[idx])
+        elif key == sg.TREE_ROOT:
+            return SegmentView(store, 0)
+        elif key == sg.STEM_ROOT:
+            return SegmentView(store, int(store.stem[idx]))
+        elif key == sg.CONTINUATIONS:
+            return [SegmentView(store, child) for child in store.children(idx)]
+        elif key == sg.BRANCHES:
+            return []
+        elif key == sg.PARENT_SEGMENT:
+            return SegmentView(store, int(store.parent[idx]))
+        elif key == sg.REST_SEGMENTS:
+            return int(store.rest_segments[idx])
+        elif key == sg.NODE:
+            return store.frame(idx)
+        elif key == sg.TREE_ROOT_NODE:
+            return store.frame(-1)
+        elif key == sg.LENGTH:
+            return float(store.length[idx])
+        elif key == sg.RADIUS:
+            return float(store.radius[idx])
+        elif key == sg.STORE_INDEX:
+            return idx
+        elif key == sg.AGE:
+            return store.age
+        elif key == sg.HELIOTROPIC_DIRECTION:
+            return Vec3(store.heliotropic_direction)
+        elif key == sg.TREE_LENGTH:
+            return store.tree_length
+        elif key == sg.ROOT_RADIUS:
+            return store.root_radius
+        elif key == sg.DEFINITION:
+            return store.definitions[store.definition[idx]]
+        elif key == sg.STEM_LENGTH:
+            return store.stem_lengths[idx]
+        elif key == sg.IS_NEW_SPLIT:
+            return (int(store.split_index[idx]), int(store.split_count[idx]))
+        elif key == sg.IS_NEW_BRANCH:
+            return float(store.branch_position[idx])
+        elif key == sg.BRANCH_RATIO:
+            return float(store.branch_ratio[idx])
@@ -0,0 +1,124 @@
+import os
+import mmap
+import json
+import struct
+import tempfile
+
+import numpy as np
+
+from panda3d.core import Vec3
+
+from tree_specs import StemDefinition as sd
+from tree_specs import definition_to_dict
+from tree_specs import definition_from_dict
+from segment_store import SegmentStore
+from segment_store import store_from_tree
+from segment_store import columns
+
+
+# Expanded trees on disk. A skeleton file is a header, a JSON block with
+# the tree-wide values, the stem definitions and the layout of the
+# columns, and then the columns of the SegmentStore, each aligned to
+# `alignment` bytes. Loading maps the file into memory and wraps the
+# columns in NumPy arrays without copying or parsing them; The loaded
+# store is read-only.
+
+
+FORMAT_VERSION = 1
+header = struct.Struct('<4sIIQ')  # magic, version, segments, metadata bytes
+magic = b'TSKL'
+suffix = '.skeleton'
+alignment = 16
+
+
+def _aligned(offset):
+    return -(-offset // alignment) * alignment
+
+
+def _definition_depths(definitions):
+    # How deep each of the store's definitions is nested in the first
+    # one's CHILD_DEFINITIONs.
+    depths = []
+    for definition in definitions:
+        depth = 0
+        current = definitions[0]
+        while current is not definition:
+            current = current[sd.CHILD_DEFINITION]
+            depth += 1
+        depths.append(depth)
+    return depths
+
+
+def _metadata(store):
+    return {
+        'seed': store.seed,
+        'age': store.age,
+        'heliotropic_direction': list(store.heliotropic_direction),
+        'tree_length': store.tree_length,
+        'root_radius': store.root_radius,
+        'stem_lengths': [[idx, length] for idx, length in store.stem_lengths.items()],
+        'definition': definition_to_dict(store.definitions[0]),
+        'definition_depths': _definition_depths(store.definitions),
+        'columns': [
+            [name, np.dtype(dtype).str, list(shape)]
+            for name, (dtype, shape) in columns.items()
+        ],
+    }
+
+
+def write_skeleton(tree, path):
+    # `tree` is an expanded tree, or a SegmentStore. The file is replaced
+    # atomically.
+    if isinstance(tree, SegmentStore):
+        store = tree
+    else:
+        store = store_from_tree(tree)
+    metadata = json.dumps(_metadata(store)).encode('utf-8')
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(header.pack(magic, FORMAT_VERSION, len(store), len(metadata)))
+        f.write(metadata)
+        for name in columns:
+            f.write(b'\0' * (_aligned(f.tell()) - f.tell()))
+            f.write(np.ascontiguousarray(getattr(store, name)).tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_skeleton(path):
+    # Returns a read-only SegmentStore whose columns are views into the
+    # memory-mapped file.
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    tag, version, size, metadata_bytes = header.unpack_from(mapped)
+    if tag != magic:
+        raise ValueError("{} is not a tree skeleton".format(path))
+    if version != FORMAT_VERSION:
+        raise ValueError("{} has skeleton format version {}, expected {}".format(path, version, FORMAT_VERSION))
+    offset = header.size
+    metadata = json.loads(mapped[offset:offset + metadata_bytes].decode('utf-8'))
+    offset += metadata_bytes
+
+    store = SegmentStore(capacity=0)
+    store.size = size
+    for name, dtype, shape in metadata['columns']:
+        dtype = np.dtype(dtype)
+        offset = _aligned(offset)
+        count = size * int(np.prod(shape, dtype=np.int64))
+        store._columns[name] = np.frombuffer(mapped, dtype=dtype, count=count, offset=offset).reshape((size, ) + tuple(shape))
+        offset += count * dtype.itemsize
+
+    root_definition = definition_from_dict(metadata['definition'])
+    for depth in metadata['definition_depths']:
+        definition = root_definition
+        for _ in range(depth):
+            definition = definition[sd.CHILD_DEFINITION]
+        store._definition_index(definition)
+    store.stem_lengths = {idx: length for idx, length in metadata['stem_lengths']}
+    store.seed = metadata['seed']
+    store.age = metadata['age']
+    store.heliotropic_direction = Vec3(*metadata['heliotropic_direction'])
+    store.tree_length = metadata['tree_length']
+    store.root_radius = metadata['root_radius']
+    return store
@@ -0,0 +1,22 @@
+from panda3d.core import NodePath
+from panda3d.core import GeomNode
+from direct.task.Task import TaskManager
+
+from forest import TreeJob
+from async_generation import AsyncTreeGenerator
+
+
+def test_request_supersedes_across_node_wrappers():
+    task_mgr = TaskManager()
+    generator = AsyncTreeGenerator(task_mgr)
+    tree_root = NodePath(GeomNode('tree'))
+
+    first = generator.request(tree_root.node(), TreeJob('BoringWillowish', 1), tropisms=False)
+    second = generator.request(tree_root.node(), TreeJob('BoringFirish', 1), tropisms=False)
+    assert first.cancelled
+    assert not second.cancelled
+
+    generator.cancel(tree_root.node())
+    assert second.cancelled
+    assert not generator.requests
+    generator.destroy()
@@ -0,0 +1,31 @@
+import numpy as np
+
+from panda3d.core import Vec3
+
+from tree_specs import Segment as sg
+from homebrew import expand_fully
+import tree_species
+import geometry
+
+
+def _tree(scene_graph):
+    tree = {
+        sg.DEFINITION: tree_species.BoringFirish,
+        sg.RNG_SEED: 5,
+        sg.AGE: 1.0,
+        sg.HELIOTROPIC_DIRECTION: Vec3(0, 0, 1),
+    }
+    expand_fully(tree, tropisms=False, scene_graph=scene_graph)
+    return tree
+
+
+def _vertices(node):
+    array = node.get_geom(0).get_vertex_data().get_array(0)
+    return np.frombuffer(memoryview(array).cast('B'), dtype=geometry.vertex_dtype)['vertex']
+
+
+def test_trimesh_of_frame_tree_matches_scene_graph_tree():
+    frame_vertices = _vertices(geometry.trimesh(_tree(scene_graph=False)))
+    scene_graph_vertices = _vertices(geometry.trimesh(_tree(scene_graph=True)))
+    assert len(frame_vertices) > 0
+    assert np.allclose(frame_vertices, scene_graph_vertices, atol=1e-4)
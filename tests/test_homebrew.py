@@ -0,0 +1,27 @@
+from panda3d.core import Vec3
+
+from tree_specs import Segment as sg
+from homebrew import expand_budgeted
+from segment_store import store_from_tree
+import benchmark
+import geometry
+
+
+def _tree():
+    return {
+        sg.DEFINITION: benchmark.stress_species(density=4.0, levels=3),
+        sg.RNG_SEED: 3,
+        sg.AGE: 1.0,
+        sg.HELIOTROPIC_DIRECTION: Vec3(0, 0, 1),
+    }
+
+
+def test_budget_result_counts_the_kept_tree():
+    for budget in [dict(max_segments=200), dict(max_segments=200, keep_partial_level=True), dict(max_vertices=3000)]:
+        tree = _tree()
+        result = expand_budgeted(tree, scene_graph=False, **budget)
+        store = store_from_tree(tree)
+        assert not result.complete
+        assert result.segments == len(store)
+        assert result.vertices == len(geometry.ring_vertices(geometry.gather_rings(store)))
+        assert result.expanded_segments >= result.segments
@@ -0,0 +1,32 @@
+from panda3d.core import Vec3
+
+from tree_specs import Segment as sg
+from tree_specs import StemDefinition as sd
+from homebrew import expand_fully
+from segment_store import store_from_tree
+import tree_species
+import leaves
+
+
+def test_leaf_ratios_lie_on_the_stem():
+    ratios = []
+
+    def leaf_size(age, ratio, rng):
+        ratios.append(ratio)
+        return 0.2
+
+    branch = dict(tree_species.BoringWillowish[sd.CHILD_DEFINITION])
+    branch[sd.LEAF_SIZE] = leaf_size
+    species = dict(tree_species.BoringWillowish)
+    species[sd.CHILD_DEFINITION] = branch
+    tree = {
+        sg.DEFINITION: species,
+        sg.RNG_SEED: 3,
+        sg.AGE: 1.0,
+        sg.HELIOTROPIC_DIRECTION: Vec3(0, 0, 1),
+    }
+    expand_fully(tree, tropisms=False, scene_graph=False)
+
+    bases, directions, sides, sizes = leaves.leaf_frames(store_from_tree(tree))
+    assert len(ratios) == len(sizes) > 0
+    assert all(0.0 <= ratio <= 1.0 for ratio in ratios)
@@ -0,0 +1,28 @@
+from panda3d.core import Vec3
+from panda3d.core import Texture
+
+from tree_specs import Segment as sg
+from homebrew import expand_fully
+from segment_store import store_from_tree
+import tree_species
+import lod
+
+
+def _store():
+    tree = {
+        sg.DEFINITION: tree_species.BoringFirish,
+        sg.RNG_SEED: 5,
+        sg.AGE: 1.0,
+        sg.HELIOTROPIC_DIRECTION: Vec3(0, 0, 1),
+    }
+    expand_fully(tree, tropisms=False, scene_graph=False)
+    return store_from_tree(tree)
+
+
+def test_impostor_only_with_texture():
+    store = _store()
+    untextured = lod.lod_node(store)
+    assert untextured.node().get_num_switches() == len(lod.default_levels)
+    textured = lod.lod_node(store, impostor_texture=Texture('impostor'))
+    assert textured.node().get_num_switches() == len(lod.default_levels) + 1
+    assert textured.get_child(len(lod.default_levels)).has_texture()
@@ -39,6 +39,9 @@ BoringWillowish = {
         sd.RADIUS: constant(0.04),
         sd.BENDING: func_curvature(constant(0.0), constant(0.0), constant(0.0)),
         sd.HELIOTROPISM: constant(0.3),
+        sd.LEAF_DENSITY: linear(4.0, 12.0),
+        sd.LEAF_SIZE: linear(0.3, 0.2),
+        sd.LEAF_ANGLE: constant(60.0),
     },
 }
 
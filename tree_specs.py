@@ -1,5 +1,8 @@
 import enum
 
+from blending_functions import to_dict
+from blending_functions import from_dict
+
 
 class StemDefinition(enum.Enum):
     NAME             = 99
@@ -16,6 +19,10 @@ class StemDefinition(enum.Enum):
     # Tropism weight functions
     DESIGN_TROPISM   = 11
     HELIOTROPISM     = 12
+    # Leaves
+    LEAF_DENSITY     = 13  # age, ratio along stem length -> leaves per segment
+    LEAF_SIZE        = 14  # age, ratio along stem length -> length and width of a leaf
+    LEAF_ANGLE       = 15  # age, ratio along stem length -> angle between stem and leaf; Optional, 45 by default.
 
 
 class Segment(enum.Enum):
@@ -23,6 +30,7 @@ class Segment(enum.Enum):
     RNG_SEED              =  1  # Seed for the random number generator.
     RNG                   =  2  # The random number generator itself.
     DEFINITION            =  3  # The StemDefinition for this stem.
+    STORE_INDEX           = 28  # Row of the segment in a SegmentStore, if it is recorded in one.
     # Parameters
     AGE                   =  4
     HELIOTROPIC_DIRECTION =  5
@@ -52,4 +60,29 @@ class Segment(enum.Enum):
     # Tropism
     DESIGN_TROPISM        = 25
     DESIGN_TWIST          = 26
-    HELIOTROPISM          = 27  # 
+    HELIOTROPISM          = 27  #
+    # Caches
+    STEM_PLANS            = 29  # homebrew.StemPlan per definition; Stored on the tree's root.
+    STEM_PLAN             = 30  # The StemPlan of the segment's stem.
+
+
+def definition_to_dict(definition):
+    # A plain dict of a StemDefinition, keyed by the names of its keys.
+    data = {}
+    for key, value in definition.items():
+        if key == StemDefinition.CHILD_DEFINITION:
+            data[key.name] = definition_to_dict(value)
+        else:
+            data[key.name] = to_dict(value)
+    return data
+
+
+def definition_from_dict(data):
+    definition = {}
+    for name, value in data.items():
+        key = StemDefinition[name]
+        if key == StemDefinition.CHILD_DEFINITION:
+            definition[key] = definition_from_dict(value)
+        else:
+            definition[key] = from_dict(value)
+    return definition